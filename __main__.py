@@ -1,52 +1,238 @@
+import asyncio
 import logging
-from typing import Type
+import os
+import sys
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Type, Optional, Dict
+from urllib.parse import urlsplit
 
 from aiogram import Bot, Dispatcher, executor
 
-from domain import MessageControllerFactory, AbstractUoW, AbstractAliasRepo
-from repo import AliasSubscriptionsRepo, SubscriptionRepo
+from domain import MessageControllerFactory, AbstractAsyncUoW, AbstractAliasRepo, ALL_PAGE_PREFIX
+from repo import (AliasSubscriptionsRepo, SubscriptionRepo, LastPostRepo, ProcessedUpdateRepo, ListenRepo, OutboxRepo,
+                  alias_index)
+from services.caches import TTLResponseCache, RenderedPostCache
+from services.dispatchers import OutboundDispatcher
+from services.extraction import THREAD, PROCESS
 from services.grabbers import Grabber, AllSubscriptionsDummyGrabber
+from services.last_posts import LastPostTracker
+from services.listen_registry import ListenRegistry
+from services.metrics import registry, MetricsServer
+from services.outbox import OutboxDispatcher, OutboxRelay
+from services.pagers import SubscriptionPager
 from services.parsers import SplitParser, ListenParser
+from services.poll_intervals import AdaptivePollInterval
+from services.pollers import SubscriptionPoller
+from services.resilience import ResilientCaller, CircuitBreaker
+from services.sessions import HTTPSessionPool
+from services.sharding import Shard
 from services.strategy_registers import QueryStrategyRegister, RepresentStrategyRegister
 from services.subscription_request_factories import SubscriptionRequestFactory, AllSubscriptionRequestFactory
-from services.unit_of_work import DjangoUoW
+from services.unit_of_work import AsyncDjangoUoW, setup_django, db_executor
+from services.webhooks import UpdateDeduplicator
 from tokens import HUDDLE_SERVICE_BOT_TOKEN as BOT_TOKEN
 
+# HUDDLE_ROLE of the process:
+ALL_ROLE = 'all'  # answers users and polls all the listened subscriptions, the default. Long polling only
+BOT_ROLE = 'bot'  # answers users and, with HUDDLE_RELAY=1, sends posts put to the outbox by poller workers
+POLLER_ROLE = 'poller'  # polls the subscriptions of HUDDLE_SHARD, e.g. 0/4, and puts new posts to the outbox
+
 if __name__ == '__main__':
+    role: str = os.environ.get('HUDDLE_ROLE', ALL_ROLE)
+    if role not in (ALL_ROLE, BOT_ROLE, POLLER_ROLE):
+        sys.exit(f'Unknown HUDDLE_ROLE: {role}')
+    if role == ALL_ROLE and os.environ.get('HUDDLE_WEBHOOK_URL'):
+        # every webhook worker would restore and poll all the listeners, so each post would be pushed by each of them
+        sys.exit('Webhook workers poll nothing: run them with HUDDLE_ROLE=bot along with HUDDLE_ROLE=poller workers')
+    setup_django()
     bot = Bot(token=BOT_TOKEN)
     dp = Dispatcher(bot)
+    # all the posts go to telegram through the single rate limited queue
+    outbound = OutboundDispatcher(bot, workers=8, global_rate=30, chat_rate=1, chat_burst=3)
 
     alias_repo: Type[AbstractAliasRepo] = AliasSubscriptionsRepo
-    uow: AbstractUoW = DjangoUoW(AliasSubscriptionsRepo)
+    uow: AbstractAsyncUoW = AsyncDjangoUoW(AliasSubscriptionsRepo)
+    # the single keep-alive connection pool for all services' queries
+    http_pool = HTTPSessionPool()
+    # users asking for the same subscription within seconds share a single service's response
+    response_cache = TTLResponseCache(ttls={'vk.com': 15}, is_cacheable=lambda data: 'error' not in data)
+    # a post of a spec hinting heavy representing is represented once while its content is the same
+    post_cache = RenderedPostCache(max_entries=4096)
+    RepresentStrategyRegister.use_post_cache(post_cache)
+    # failing queries are retried a couple of times, then a failing service isn't queried for a while
+    resilience = ResilientCaller(CircuitBreaker(failure_threshold=5, reset_timeout=30), attempts=3, base_delay=0.5)
+    # strategies hinting heavy representing are run out of the event loop as well as decoding of responses over 256KB.
+    # Worker processes are spawned only if a registered spec hints them
+    represent_executors: Dict[str, Executor] = {THREAD: ThreadPoolExecutor(max_workers=4,
+                                                                           thread_name_prefix='represent')}
+    if PROCESS in RepresentStrategyRegister.cost_hints():
+        represent_executors[PROCESS] = ProcessPoolExecutor(max_workers=2)
+    grabber = Grabber(QueryStrategyRegister, RepresentStrategyRegister, session_pool=http_pool, cache=response_cache,
+                      resilience=resilience, executors=represent_executors, offload_decoding_from=256 * 1024)
+    # remembers posts already sent to listening users
+    tracker = LastPostTracker(AsyncDjangoUoW(LastPostRepo), flush_interval=10)
+    # polls each subscription for all the listening users as often as the subscription posts
+    poll_intervals = AdaptivePollInterval(initial=20, min_interval=10, max_interval=600)
+    poller = SubscriptionPoller(grabber, interval=20, tracker=tracker, intervals=poll_intervals)
+    # listening survives restarts. Stored listeners are restored in batches with their first polls spread over 20s
+    if role == ALL_ROLE:
+        listen_registry = ListenRegistry(AsyncDjangoUoW(ListenRepo), poller, outbound,
+                                         batch_size=100, batch_interval=1, spread=20)
+    elif role == BOT_ROLE:
+        # listening is only stored for poller workers, their posts come through the shared db
+        listen_registry = ListenRegistry(AsyncDjangoUoW(ListenRepo), None, outbound)
+    else:
+        # a worker polls only subscriptions of its shard and picks up users' commands from the db every 5s
+        outbox = OutboxDispatcher(AsyncDjangoUoW(OutboxRepo))
+        listen_registry = ListenRegistry(AsyncDjangoUoW(ListenRepo), poller, outbox,
+                                         batch_size=100, batch_interval=1, spread=20,
+                                         shard=Shard.parse(os.environ.get('HUDDLE_SHARD', '0/1')), sync_interval=5)
+    outbox_relay = OutboxRelay(AsyncDjangoUoW(OutboxRepo), outbound, batch_size=100, interval=1)
+
+    # public url telegram sends updates to, e.g. https://example.com/bot. The bot uses long polling if it isn't set.
+    # Several workers may serve the same url behind a load balancer or share the port on the same host
+    webhook_url: Optional[str] = os.environ.get('HUDDLE_WEBHOOK_URL')
+    # the outbox is relayed by a single bot process, so its posts keep telegram limits and the order within a chat.
+    # Set HUDDLE_RELAY=1 for exactly one of webhook workers, a long polling bot relays by default
+    relay: bool = os.environ.get('HUDDLE_RELAY', '0' if webhook_url else '1') == '1'
+    deduplicator: Optional[UpdateDeduplicator] = None
+    if webhook_url:
+        # an update redelivered to another worker is skipped by it
+        deduplicator = UpdateDeduplicator(AsyncDjangoUoW(ProcessedUpdateRepo))
+        dp.middleware.setup(deduplicator)
+
+    # hot path timings and counters are at http://127.0.0.1:9100/metrics. Workers on the same host need own ports
+    metrics_server = MetricsServer(registry, host='127.0.0.1', port=int(os.environ.get('HUDDLE_METRICS_PORT', 9100)))
+    registry.gauge('huddle_outbound_queue_size', 'Posts jobs waiting to be sent', collect=lambda: outbound.queue_size)
+    for stat, metric_type in (('hits', 'counter'), ('misses', 'counter'), ('coalesced', 'counter'),
+                              ('stale_hits', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')):
+        registry.gauge(f'huddle_cache_{stat}{"_total" if metric_type == "counter" else ""}', f'Response cache {stat}',
+                       collect=lambda stat=stat: response_cache.stats()[stat], metric_type=metric_type)
+    for stat, metric_type in (('hits', 'counter'), ('misses', 'counter'), ('entries', 'gauge')):
+        registry.gauge(f'huddle_post_cache_{stat}{"_total" if metric_type == "counter" else ""}',
+                       f'Rendered post cache {stat}',
+                       collect=lambda stat=stat: post_cache.stats()[stat], metric_type=metric_type)
+
+    if role == POLLER_ROLE:
+        async def start_poller_worker():
+            tracker.start()
+            poller.start()
+            listen_registry.start()
+            await metrics_server.start()
+            logging.warning(f'Poller worker of shard {os.environ.get("HUDDLE_SHARD", "0/1")} is running')
+
+        async def stop_poller_worker():
+            await metrics_server.stop()
+            await listen_registry.stop()
+            await poller.stop()
+            await outbox.stop()
+            await tracker.stop()
+            await http_pool.close()
+            [_.shutdown(wait=False) for _ in represent_executors.values()]
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(start_poller_worker())
+        try:
+            loop.run_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            loop.run_until_complete(stop_poller_worker())
+        sys.exit()
 
     command = 'listen'
     listen_message_controller = MessageControllerFactory(
-        grabber=Grabber(QueryStrategyRegister, RepresentStrategyRegister),
+        grabber=grabber,
         parser=ListenParser(),
         subscription_request_factory=SubscriptionRequestFactory(uow=uow),
-        command=command)
+        command=command,
+        listen_registry=listen_registry,
+        dispatcher=outbound)
     listen_message_controller = dp.message_handler(commands=[command])(listen_message_controller)
 
+    command = 'stop'
+    stop_listen_message_controller = MessageControllerFactory(
+        grabber=grabber,
+        parser=ListenParser(command='/stop'),
+        subscription_request_factory=SubscriptionRequestFactory(uow=uow),
+        command=command,
+        listen_registry=listen_registry,
+        dispatcher=outbound)
+    stop_listen_message_controller = dp.message_handler(commands=[command])(stop_listen_message_controller)
+
     command = 'all'
-    all_uow: AbstractUoW = DjangoUoW(SubscriptionRepo)
+    all_uow: AbstractAsyncUoW = AsyncDjangoUoW(SubscriptionRepo)
+    # /all is a single message paged with inline buttons
+    pager = SubscriptionPager(all_uow, page_size=100)
     all_subscriptions_message_controller = MessageControllerFactory(
         grabber=AllSubscriptionsDummyGrabber(),
         parser=SplitParser(),
         subscription_request_factory=AllSubscriptionRequestFactory(uow=all_uow),
-        command=command)
+        command=command,
+        dispatcher=outbound,
+        pager=pager)
     all_subscriptions_message_controller = dp.message_handler(commands=[command])(all_subscriptions_message_controller)
 
+    command = 'all_page'
+    all_subscriptions_page_controller = MessageControllerFactory(
+        grabber=AllSubscriptionsDummyGrabber(),
+        parser=SplitParser(),
+        subscription_request_factory=AllSubscriptionRequestFactory(uow=all_uow),
+        command=command,
+        pager=pager)
+    # game and inline callbacks have no data
+    all_subscriptions_page_controller = dp.callback_query_handler(
+        lambda callback_query: (callback_query.data or '').startswith(ALL_PAGE_PREFIX)
+    )(all_subscriptions_page_controller)
+
     command = ''
     message_controller = MessageControllerFactory(
-        grabber=Grabber(QueryStrategyRegister, RepresentStrategyRegister),
+        grabber=grabber,
         parser=SplitParser(),
         subscription_request_factory=SubscriptionRequestFactory(uow=uow),
-        command=command)
+        command=command,
+        dispatcher=outbound)
     message_controller = dp.message_handler()(message_controller)
 
 
     async def on_startup(_):
+        async with uow:  # loads the alias index
+            pass
+        alias_index.start(interval=60, executor=db_executor)
+        outbound.start()
+        if role == ALL_ROLE:
+            tracker.start()
+            poller.start()
+        elif relay:
+            outbox_relay.start()
+        listen_registry.start()
+        await metrics_server.start()
+        if deduplicator is not None:
+            deduplicator.start()
+            # every worker sets the same url, so it doesn't matter which one starts first
+            await bot.set_webhook(webhook_url, max_connections=100)
         logging.warning('Bot is running')
 
 
-    executor.start_polling(dp, on_startup=on_startup)
+    async def on_shutdown(_):
+        # the webhook isn't deleted since other workers keep serving it
+        if deduplicator is not None:
+            await deduplicator.stop()
+        await metrics_server.stop()
+        await listen_registry.stop()
+        await outbox_relay.stop()
+        await poller.stop()
+        await tracker.stop()
+        await alias_index.stop()
+        await outbound.stop()
+        await http_pool.close()
+        [_.shutdown(wait=False) for _ in represent_executors.values()]
+
+
+    if webhook_url:
+        executor.start_webhook(dp, webhook_path=urlsplit(webhook_url).path or '/', on_startup=on_startup,
+                               on_shutdown=on_shutdown, skip_updates=False,
+                               host=os.environ.get('HUDDLE_WEBHOOK_HOST', '0.0.0.0'),
+                               port=int(os.environ.get('HUDDLE_WEBHOOK_PORT', 8080)), reuse_port=True)
+    else:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
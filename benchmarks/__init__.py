@@ -0,0 +1,4 @@
+"""
+Benchmarks of the message pipeline: parse -> resolve -> grab -> represent -> send.
+Run with `python -m benchmarks --help`. The vk.com api and the telegram bot are replaced with local stand-ins
+"""
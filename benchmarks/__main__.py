@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Callable, Optional
+
+from aiogram import types
+
+import benchmarks
+from services.unit_of_work import setup_django, AsyncDjangoUoW, db_executor
+
+BENCHMARK_SETTINGS = 'benchmarks.settings'
+
+
+@dataclass
+class Scenario:
+    name: str
+    users: int  # users sending a message at once
+    aliases_per_message: int
+    groups: int  # distinct subscriptions in the db
+    description: str
+
+
+SCENARIOS: Dict[str, Scenario] = {_.name: _ for _ in (
+    Scenario('concurrent_users', users=1000, aliases_per_message=3, groups=50,
+             description='1k users asking for a few subscriptions at once'),
+    Scenario('many_aliases', users=10, aliases_per_message=100, groups=100,
+             description='messages with 100 aliases each'),
+    Scenario('single', users=1, aliases_per_message=1, groups=1,
+             description='a single user asking for a single subscription'),
+)}
+
+
+@dataclass
+class Report:
+    scenario: str
+    messages: int
+    posts: int
+    seconds: float
+    latencies: List[float] = field(repr=False)  # seconds per message
+    db_queries: int
+    vk_requests: int
+    vk_calls: int
+    bot_calls: int
+    cache: Dict[str, Any]
+
+    def percentile(self, percent: int) -> float:
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method='inclusive')[percent - 1]
+
+    def __str__(self) -> str:
+        return (f'{self.scenario}: {self.messages} messages, {self.posts} posts in {self.seconds:.2f}s\n'
+                f'  throughput: {self.messages / self.seconds:.1f} messages/s, {self.posts / self.seconds:.1f} posts/s\n'
+                f'  latency ms: p50 {self.percentile(50) * 1000:.1f}, p95 {self.percentile(95) * 1000:.1f}, '
+                f'p99 {self.percentile(99) * 1000:.1f}\n'
+                f'  db queries: {self.db_queries}, vk requests: {self.vk_requests} ({self.vk_calls} api calls), '
+                f'bot api calls: {self.bot_calls}\n'
+                f'  cache: {self.cache}')
+
+
+class QueryCounter:
+    """Counts sql queries of every db connection after .install(). A new installed counter replaces the previous"""
+    current: Optional['QueryCounter'] = None
+
+    def __init__(self):
+        self.queries: int = 0
+
+    def __call__(self, execute: Callable, sql: str, params: Any, many: bool, context: Dict[str, Any]) -> Any:
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def install(self) -> None:
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+        QueryCounter.current = self
+        connection_created.connect(_count_queries_of, weak=False, dispatch_uid='benchmark_query_counter')
+        for connection in connections.all():  # the ones already known in this thread
+            _count_queries_of(connection=connection)
+
+
+def _count_queries_of(connection: Any, **kwargs) -> None:
+    wrappers: List[Callable] = connection.execute_wrappers
+    wrappers[:] = [_ for _ in wrappers if not isinstance(_, QueryCounter)] + [QueryCounter.current]
+
+
+def seed(groups: int) -> List[str]:
+    """Creates a fresh db with the given number of vk.com groups. Returns their aliases"""
+    from django.core.management import call_command
+    from django.db import connection
+    from web_app.huddle_service_bot import models
+    from repo import alias_index
+    from services.represent_strategies import OLDCLOTHERS_SPEC
+    from services.strategy_registers import RepresentStrategyRegister
+
+    connection.close()
+    name: str = connection.settings_dict['NAME']
+    if os.path.exists(name):
+        os.remove(name)
+    call_command('migrate', verbosity=0)
+    models.Service.objects.create(id=1, service_token='vk.com')
+    models.Subscription.objects.bulk_create(
+        [models.Subscription(id=_ + 1, subscription_token=f'group_{_}', service_id=1) for _ in range(groups)])
+    aliases: List[str] = [f'g{_}' for _ in range(groups)]
+    models.SubscriptionAlias.objects.bulk_create(
+        [models.SubscriptionAlias(id=_ + 1, alias=alias, alias_normalized=models.SubscriptionAlias.normalize(alias),
+                                  subscription_id=_ + 1) for _, alias in enumerate(aliases)])
+    for _ in range(groups):
+        RepresentStrategyRegister.register('vk.com', f'group_{_}', OLDCLOTHERS_SPEC)
+    # bulk creating doesn't send signals, so the index is reloaded by hand
+    alias_index.bind(models.SubscriptionAlias)
+    alias_index.load()
+    connection.close()  # the pipeline uses its own connection in the db thread
+    return aliases
+
+
+def make_message(user_id: int, text: str) -> types.Message:
+    return types.Message(**{'message_id': user_id,
+                            'date': int(time.time()),
+                            'chat': {'id': user_id, 'type': 'private'},
+                            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+                            'text': text})
+
+
+async def run(scenario: Scenario, args: argparse.Namespace) -> Report:
+    from benchmarks.fake_bot import FakeBot
+    from benchmarks.fake_vk import FakeVK
+    from domain import MessageControllerFactory
+    from repo import AliasSubscriptionsRepo
+    from services.caches import TTLResponseCache
+    from services.dispatchers import OutboundDispatcher
+    from services.grabbers import Grabber
+    from services.parsers import SplitParser
+    from services.query_strategies import VKQueryStrategy
+    from services.resilience import ResilientCaller
+    from services.sessions import HTTPSessionPool
+    from services.strategy_registers import QueryStrategyRegister, RepresentStrategyRegister
+    from services.subscription_request_factories import SubscriptionRequestFactory
+
+    aliases: List[str] = await asyncio.get_event_loop().run_in_executor(db_executor, seed, scenario.groups)
+    counter = QueryCounter()
+    await asyncio.get_event_loop().run_in_executor(db_executor, counter.install)
+
+    vk = FakeVK(latency=args.vk_latency, error_rate=args.error_rate)
+    await vk.start()
+    VKQueryStrategy.api_url = vk.url
+    bot = FakeBot(latency=args.bot_latency)
+    # telegram limits would make the benchmark measure only them
+    outbound = OutboundDispatcher(bot, workers=args.workers, global_rate=1e6, chat_rate=1e6, chat_burst=1e6)
+    http_pool = HTTPSessionPool()
+    cache = TTLResponseCache(ttls={'vk.com': 15}, is_cacheable=lambda data: 'error' not in data)
+    grabber = Grabber(QueryStrategyRegister, RepresentStrategyRegister, session_pool=http_pool,
+                      cache=None if args.no_cache else cache,
+                      batch_window=None if args.no_batch else 0.01,
+                      resilience=ResilientCaller(base_delay=0.05))
+    controller = MessageControllerFactory(parser=SplitParser(),
+                                          subscription_request_factory=SubscriptionRequestFactory(
+                                              uow=AsyncDjangoUoW(AliasSubscriptionsRepo, settings=BENCHMARK_SETTINGS)),
+                                          grabber=grabber,
+                                          dispatcher=outbound)
+    outbound.start()
+    latencies: List[float] = []
+
+    async def user(user_id: int) -> None:
+        text: str = ' '.join(aliases[(user_id + _) % len(aliases)] for _ in range(scenario.aliases_per_message))
+        started: float = time.perf_counter()
+        await controller(make_message(user_id, text))
+        latencies.append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(user(_ + 1) for _ in range(scenario.users)))
+        seconds: float = time.perf_counter() - started
+    finally:
+        await outbound.stop()
+        await http_pool.close()
+        await vk.stop()
+    return Report(scenario=scenario.name,
+                  messages=scenario.users,
+                  posts=scenario.users * scenario.aliases_per_message,
+                  seconds=seconds,
+                  latencies=latencies,
+                  db_queries=counter.queries,
+                  vk_requests=vk.requests,
+                  vk_calls=vk.calls,
+                  bot_calls=len(bot.calls),
+                  cache=cache.stats())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=benchmarks.__doc__)
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help='scenarios to run, all of them by default: ' +
+                             '; '.join(f'{_.name} - {_.description}' for _ in SCENARIOS.values()))
+    parser.add_argument('--users', type=int, help='overrides users of the scenarios')
+    parser.add_argument('--aliases', type=int, help='overrides aliases per message of the scenarios')
+    parser.add_argument('--vk-latency', type=float, default=0.05, help='seconds of every vk api answer')
+    parser.add_argument('--bot-latency', type=float, default=0.01, help='seconds of every telegram api call')
+    parser.add_argument('--error-rate', type=float, default=0., help='share of vk api calls answering with error')
+    parser.add_argument('--workers', type=int, default=8, help='workers of the outbound dispatcher')
+    parser.add_argument('--no-cache', action='store_true', help='disables the response cache')
+    parser.add_argument('--no-batch', action='store_true', help='disables batching of vk api calls')
+    args = parser.parse_args()
+    unknown: List[str] = [_ for _ in args.scenarios if _ not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {unknown}')
+
+    logging.basicConfig(level=logging.ERROR)
+    setup_django(BENCHMARK_SETTINGS)
+    for name in args.scenarios:
+        scenario: Scenario = SCENARIOS[name]
+        scenario = Scenario(scenario.name,
+                            users=args.users or scenario.users,
+                            aliases_per_message=args.aliases or scenario.aliases_per_message,
+                            groups=max(scenario.groups, args.aliases or 0),
+                            description=scenario.description)
+        print(asyncio.run(run(scenario, args)))
+
+
+if __name__ == '__main__':
+    main()
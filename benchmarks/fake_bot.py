@@ -0,0 +1,25 @@
+import asyncio
+from typing import List, Tuple, Any, Optional
+
+
+class FakeBot:
+    """Stand-in of aiogram Bot for OutboundDispatcher. Records api calls and answers after the given latency"""
+
+    def __init__(self, latency: float = 0.):
+        self._latency = latency
+        self.calls: List[Tuple[str, int]] = []  # (method, chat id)
+
+    async def _call(self, method: str, chat_id: int) -> None:
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        self.calls.append((method, chat_id))
+
+    async def send_message(self, chat_id: int, text: str, reply_markup: Optional[Any] = None, **kwargs) -> None:
+        await self._call('sendMessage', chat_id)
+
+    async def send_photo(self, chat_id: int, photo: str, caption: Optional[str] = None,
+                         reply_markup: Optional[Any] = None, **kwargs) -> None:
+        await self._call('sendPhoto', chat_id)
+
+    async def send_media_group(self, chat_id: int, media: Any, **kwargs) -> None:
+        await self._call('sendMediaGroup', chat_id)
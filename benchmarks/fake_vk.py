@@ -0,0 +1,93 @@
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Dict, Any, List, Optional
+
+from aiohttp import web
+
+_WALL_GET_CALL = re.compile(r'API\.wall\.get\((\{.*?\})\)')
+
+
+class FakeVK:
+    """
+    Local stand-in of vk.com api answering wall.get and execute with generated posts.
+    Every group publishes a new post each post_interval seconds. Latency and errors are injected per api call:
+    error_rate of calls answer with a flood control error
+    """
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0., post_interval: float = 60.,
+                 photos_per_post: int = 2, host: str = '127.0.0.1', port: int = 0):
+        self._latency = latency
+        self._error_rate = error_rate
+        self._post_interval = post_interval
+        self._photos_per_post = photos_per_post
+        self._host = host
+        self._port = port
+        self._started_at: float = time.time()
+        self._runner: Optional[web.AppRunner] = None
+        self.url: str = ''
+        self.requests: int = 0  # http requests
+        self.calls: int = 0  # api calls including ones inside execute
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/method/wall.get', self._wall_get)
+        app.router.add_get('/method/execute', self._execute)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        port: int = self._runner.addresses[0][1]
+        self.url = f'http://{self._host}:{port}/method'
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _wall_get(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self._latency)
+        return web.json_response(self._wall(request.query['domain'], int(request.query.get('count', 1))))
+
+    async def _execute(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self._latency)
+        results: List[Any] = []
+        errors: List[Dict[str, Any]] = []
+        for call in _WALL_GET_CALL.findall(request.query['code']):
+            params: Dict[str, Any] = json.loads(call)
+            answer: Dict[str, Any] = self._wall(params['domain'], params.get('count', 1))
+            if 'error' in answer:
+                results.append(False)
+                errors.append(dict(answer['error'], method='wall.get'))
+            else:
+                results.append(answer['response'])
+        answer = {'response': results}
+        if errors:
+            answer['execute_errors'] = errors
+        return web.json_response(answer)
+
+    def _wall(self, domain: str, count: int) -> Dict[str, Any]:
+        self.calls += 1
+        if random.random() < self._error_rate:
+            return {'error': {'error_code': 9, 'error_msg': 'Flood control'}}
+        latest: int = int((time.time() - self._started_at) / self._post_interval) + 1000
+        return {'response': {'count': latest, 'items': [self._post(domain, _) for _ in range(latest, latest - count, -1)]}}
+
+    def _post(self, domain: str, post_id: int) -> Dict[str, Any]:
+        """A post shaped like a real one including values represent strategies don't need"""
+        return {'id': post_id,
+                'owner_id': -1,
+                'date': int(self._started_at + (post_id - 1000) * self._post_interval),
+                'text': f'Post {post_id} of {domain} #benchmark',
+                'attachments': [{'type': 'photo',
+                                 'photo': {'id': _, 'sizes': [{'type': size, 'url': f'https://example.com/{size}{_}.jpg',
+                                                               'width': 100, 'height': 100} for size in 'smxyz']}}
+                                for _ in range(self._photos_per_post)],
+                'comments': {'count': 0},
+                'likes': {'count': 10, 'user_likes': 0},
+                'reposts': {'count': 0},
+                'views': {'count': 100}}
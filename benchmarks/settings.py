@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+from web_app.web_app.settings import *
+
+# benchmarks seed their own database, so the bot's one is never touched
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('HUDDLE_BENCHMARK_DB', os.path.join(tempfile.gettempdir(), 'huddle_benchmark.sqlite3')),
+        'CONN_MAX_AGE': 600,
+    }
+}
@@ -7,18 +7,36 @@ __all__ = ['SubscriptionRequest',
            'CommandType',
            'IGrabber',
            'IParser',
+           'IPoller',
+           'IDispatcher',
+           'IPager',
+           'ALL_PAGE_PREFIX',
+           'SendPriority',
            'AbstractRepo',
            'AbstractSubscriptionRepo',
            'AbstractAliasRepo',
+           'AliasResolution',
+           'ListenSession',
+           'OutboxEntry',
+           'AbstractOutboxRepo',
+           'IListenRegistry',
+           'AbstractListenRepo',
+           'AbstractLastPostRepo',
+           'AbstractProcessedUpdateRepo',
+           'LastPostKey',
            'AbstractUoW',
+           'AbstractAsyncUoW',
            'ISubscriptionRequestFactory',
            'MessageControllerFactory',
            ]
 
 from abc import ABC, abstractmethod
-from asyncio import sleep
+from asyncio import Semaphore, Task, ensure_future, as_completed
 from dataclasses import dataclass
-from typing import Iterable, List, Protocol, Tuple, Set, Union, Dict, Any, Coroutine, NewType, Optional
+from datetime import datetime
+from enum import IntEnum
+from typing import (Iterable, List, Protocol, Tuple, Set, Union, Dict, Any, Coroutine, NewType, Optional,
+                    AsyncIterator, Awaitable, Callable)
 
 from aiogram import types
 
@@ -28,6 +46,8 @@ class SubscriptionRequest:
     service: Optional[str]  # service with api
     subscription_token: str  # id, domain, group_id etc. to use with the service
     tg_user_id: int  # telegram user id
+    since_post_id: Optional[str] = None  # if given, only posts newer than this one are requested
+    polling: bool = False  # is made by the poller for listeners rather than asked for by the user
 
 
 @dataclass
@@ -35,6 +55,34 @@ class BotPost:
     """DTO to be given to handler to send user"""
     text: str
     photo_urls: List[str]
+    post_id: Optional[str] = None  # id of the post inside the service if it's known
+    keyboard: Optional[types.InlineKeyboardMarkup] = None  # is attached to the text
+    published_at: Optional[float] = None  # unix time the post was published inside the service if it's known
+
+
+@dataclass
+class AliasResolution:
+    """Result of resolving several aliases at once"""
+    resolved: Dict[str, Tuple[str, str]]  # alias as given -> (service token, subscription token)
+    unknown: List[str]  # aliases as given which have no subscription
+
+
+@dataclass
+class ListenSession:
+    """A user listening to a subscription as it's stored"""
+    service: str
+    subscription_token: str
+    tg_user_id: int
+    chat_id: int  # where new posts are sent
+    last_post_id: Optional[str] = None  # the last post delivered to the user if any
+    listening: bool = True  # False if the user has stopped listening
+
+
+# Prefix of callback data of buttons turning pages of /all listing
+ALL_PAGE_PREFIX = 'all:'
+
+# (telegram user id, subscription token) to track the last post delivered to the user
+LastPostKey = Tuple[int, str]
 
 
 # Custom JSON type to clarify various methods return
@@ -49,16 +97,18 @@ Alias = NewType('Alias', str)
 
 class IGrabber(Protocol):
     """
-    Responsible for querying service api and preparing answer
+    Responsible for querying service api and preparing answer.
+    Querying is awaitable so a slow service doesn't block the event loop
     """
 
-    def handle(self, subscription_request: SubscriptionRequest) -> BotPost:
+    async def handle(self, subscription_request: SubscriptionRequest) -> List[BotPost]:
+        """Returns the latest post or every post newer than subscription_request.since_post_id"""
         ...
 
-    def query(self, subscription_request: SubscriptionRequest) -> JSONType:
+    async def query(self, subscription_request: SubscriptionRequest) -> JSONType:
         ...
 
-    def represent_response(self, subscription_request: SubscriptionRequest, data: JSONType) -> BotPost:
+    def represent_response(self, subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
         ...
 
 
@@ -69,6 +119,63 @@ class IParser(Protocol):
         ...
 
 
+class IPoller(Protocol):
+    """Polls subscriptions on its own and delivers new posts to subscribed listeners"""
+
+    def subscribe(self, subscription_request: SubscriptionRequest, listener_id: int,
+                  callback: Callable[[BotPost], Awaitable[None]], delay: float = 0.) -> None:
+        """delay: float seconds before the first poll of a subscription nobody listens to yet"""
+        ...
+
+    def unsubscribe(self, subscription_request: SubscriptionRequest, listener_id: int) -> None:
+        ...
+
+    def unsubscribe_all(self, listener_id: int) -> None:
+        ...
+
+
+class IListenRegistry(Protocol):
+    """Keeps users' listening to subscriptions across restarts and subscribes them to the poller"""
+
+    async def listen(self, chat_id: int, subscription_requests: Iterable[SubscriptionRequest]) -> None:
+        ...
+
+    async def stop_listening(self, tg_user_id: int,
+                             subscription_requests: Optional[Iterable[SubscriptionRequest]] = None) -> None:
+        """Stops listening to the given subscriptions or to all of them if None is given"""
+        ...
+
+
+class IPager(Protocol):
+    """Splits a long listing into pages fitting a single message each"""
+
+    async def get_page(self, cursor: Optional[str]) -> Tuple[str, Optional[str]]:
+        """Returns text of the page starting after cursor and the cursor of the next page if there is one"""
+        ...
+
+
+class SendPriority(IntEnum):
+    """Posts with lower value are sent first"""
+    INTERACTIVE = 0  # answers to user's messages
+    LISTEN = 1  # posts pushed to listening users
+
+
+@dataclass
+class OutboxEntry:
+    """A post waiting in the outbox to be sent to a chat"""
+    chat_id: int
+    post: BotPost
+    priority: SendPriority = SendPriority.LISTEN
+    entry_id: Optional[int] = None  # is set for stored entries
+
+
+class IDispatcher(Protocol):
+    """Sends BotPosts to telegram chats keeping telegram limits"""
+
+    async def send(self, chat_id: int, posts: List[BotPost], priority: SendPriority) -> None:
+        ...
+
+
 class AbstractRepo(ABC):
     model_name: str
 
@@ -81,6 +188,11 @@ class AbstractAliasRepo(AbstractRepo):
         """Returns service services and subscription token by alias"""
         ...
 
+    @abstractmethod
+    def get_subscriptions_info_by(self, aliases: Iterable[str]) -> AliasResolution:
+        """Resolves all the given aliases into service and subscription tokens at once"""
+        ...
+
     @abstractmethod
     def all_aliases_as_set(self) -> Set[str]:
         """Returns all stored aliases as set"""
@@ -94,6 +206,88 @@ class AbstractSubscriptionRepo(AbstractRepo):
     def get_all_subscriptions_as_set(self) -> Set[str]:
         ...
 
+    @abstractmethod
+    def get_subscriptions_page(self, after: Optional[int], limit: int) -> List[Tuple[int, str]]:
+        """Returns at most limit (id, subscription token) pairs ordered by id which go after the given id"""
+        ...
+
+
+class AbstractLastPostRepo(AbstractRepo):
+    """Abstract repo to determine which posts of subscriptions have been already delivered to users"""
+
+    @abstractmethod
+    def get_last_post_ids(self, keys: Iterable[LastPostKey]) -> Dict[LastPostKey, Optional[str]]:
+        """Returns the last delivered post id for each of given keys which is stored"""
+        ...
+
+    @abstractmethod
+    def update_last_post_ids(self, last_post_ids: Dict[LastPostKey, str]) -> None:
+        """Stores the last delivered post ids in bulk"""
+        ...
+
+
+class AbstractListenRepo(AbstractRepo):
+    """Abstract repo of users listening to subscriptions"""
+
+    @abstractmethod
+    def listen(self, sessions: Iterable[ListenSession]) -> None:
+        """Stores the sessions keeping the last delivered posts of already known ones"""
+        ...
+
+    @abstractmethod
+    def stop_listening(self, tg_user_id: int, subscription_tokens: Optional[Iterable[str]] = None) -> None:
+        """Stops the user's listening to the given subscriptions or to all of them if None is given"""
+        ...
+
+    @abstractmethod
+    def get_listen_sessions_page(self, after: Optional[int], limit: int,
+                                 shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, ListenSession]]:
+        """
+        Returns at most limit of (id, session) ordered by id which is greater than after.
+        shard: (index, count) if given, only sessions of subscriptions whose crc32 of the token modulo count is index
+        """
+        ...
+
+    @abstractmethod
+    def get_listen_changes_page(self, since: datetime, after: Optional[int], limit: int,
+                                shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, ListenSession]]:
+        """Same as get_listen_sessions_page for sessions started or stopped since the moment, stopped ones included"""
+        ...
+
+
+class AbstractOutboxRepo(AbstractRepo):
+    """Abstract repo of posts waiting to be sent to telegram by another process"""
+
+    @abstractmethod
+    def put(self, entries: Iterable[OutboxEntry]) -> None:
+        ...
+
+    @abstractmethod
+    def claim(self, claimer: str, limit: int, lease: float) -> List[OutboxEntry]:
+        """
+        Claims at most limit of the oldest entries nobody has claimed for lease seconds and returns them.
+        An entry is claimed by a single claimer at a time
+        """
+        ...
+
+    @abstractmethod
+    def delete(self, entry_ids: Iterable[int]) -> None:
+        ...
+
+
+class AbstractProcessedUpdateRepo(AbstractRepo):
+    """Abstract repo of telegram updates already taken by the bot's workers"""
+
+    @abstractmethod
+    def mark_processed(self, update_id: int) -> bool:
+        """Marks the update as processed. Returns False if it has been marked before by any worker"""
+        ...
+
+    @abstractmethod
+    def forget_processed_before(self, seconds: float) -> int:
+        """Forgets updates processed earlier than the given seconds ago. Returns how many are forgotten"""
+        ...
+
 
 class AbstractUoW(ABC):
     storage: Optional[AbstractRepo]
@@ -106,14 +300,30 @@ class AbstractUoW(ABC):
         ...
 
 
+class AbstractAsyncUoW(ABC):
+    """
+    Unit of work to be used inside the event loop. Repository methods are awaited:
+        async with uow:
+            await uow.storage.method(...)
+    """
+    storage: Any
+
+    async def __aenter__(self) -> AbstractAsyncUoW:
+        return self
+
+    @abstractmethod
+    async def __aexit__(self, *args):
+        ...
+
+
 class ISubscriptionRequestFactory(Protocol):
-    def __init__(self, uow: AbstractUoW) -> None:
+    def __init__(self, uow: AbstractAsyncUoW) -> None:
         """Need to know where to get info about subscriptions"""
         ...
 
-    def get_subscription_request_pool(self,
-                                      commands: Iterable[CommandType],
-                                      tg_user_id: int) -> Iterable[SubscriptionRequest]:
+    async def get_subscription_request_pool(self,
+                                            commands: Iterable[CommandType],
+                                            tg_user_id: int) -> Iterable[SubscriptionRequest]:
         """
         Creates an iterable of SubscriptionRequest objects which are corresponds to the given commands
         from one telegram user
@@ -129,77 +339,165 @@ class MessageControllerFactory:
     def __init__(self, parser: IParser,
                  subscription_request_factory: ISubscriptionRequestFactory,
                  grabber: IGrabber,
-                 command: str = ''):
+                 command: str = '',
+                 max_concurrency: int = 8,
+                 ordered: bool = True,
+                 poller: Optional[IPoller] = None,
+                 dispatcher: Optional[IDispatcher] = None,
+                 pager: Optional[IPager] = None,
+                 listen_registry: Optional[IListenRegistry] = None):
+        """
+        max_concurrency: int the most of subscription requests of one message being grabbed at once
+        ordered: bool if True posts are sent in the order of user's aliases, otherwise as soon as each is grabbed
+        poller: IPoller shared poller which listen commands subscribe users to
+        dispatcher: IDispatcher if given, posts are sent through it instead of answering the message directly
+        pager: IPager if given, /all is answered with a single message turning pages with inline buttons
+        listen_registry: IListenRegistry if given, listen commands are stored and survive restarts.
+        The poller isn't used directly then
+        """
+        if max_concurrency < 1:
+            raise ValueError(f'max_concurrency should be positive: {max_concurrency=}')
         self._parser = parser
         self._subscription_request_factory = subscription_request_factory
         self._grabber = grabber
         self._command = command
+        self._max_concurrency = max_concurrency
+        self._ordered = ordered
+        self._poller = poller
+        self._dispatcher = dispatcher
+        self._pager = pager
+        self._listen_registry = listen_registry
+
+    async def _grab_concurrently(self,
+                                 subscription_requests: Iterable[SubscriptionRequest]) -> AsyncIterator[BotPost]:
+        """
+        Grabs all the subscription requests concurrently, at most self._max_concurrency at once.
+        Yields BotPosts either in the order of requests or in the order of completion
+        """
+        semaphore = Semaphore(self._max_concurrency)
+
+        async def grab(subscription_request: SubscriptionRequest) -> List[BotPost]:
+            async with semaphore:
+                return await self._grabber.handle(subscription_request)
+
+        tasks: List[Task] = [ensure_future(grab(_)) for _ in subscription_requests]
+        try:
+            pending: Iterable[Awaitable[List[BotPost]]] = tasks if self._ordered else as_completed(tasks)
+            for task in pending:
+                for post in await task:
+                    yield post
+        finally:
+            [task.cancel() for task in tasks if not task.done()]
+
+    async def _answer(self, message: types.Message, post: BotPost,
+                      priority: SendPriority = SendPriority.INTERACTIVE):
+        """Answers with photos and text if exists"""
+        if self._dispatcher is not None:
+            await self._dispatcher.send(message.chat.id, [post], priority)
+            return
+        media = types.MediaGroup()
+        for url in post.photo_urls:
+            media.attach_photo(url)
+        if post.photo_urls:
+            await message.answer_media_group(media)
+        await message.answer(post.text, reply_markup=post.keyboard)
 
     async def message_controller(self, message: types.Message):
         """
-        Fetches a list of BotPosts from handler and forms answer for each BotPost.
+        Grabs a BotPost for each of parsed commands and forms answer for each BotPost.
         Answers with photos and text if exists"""
         user_text: str = message.text
         tg_user_id: int = message.from_user.id
         parsed_commands: Iterable[Alias] = self._parser.parse(user_text)
         subscription_requests: Iterable[SubscriptionRequest] = \
-            self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
+            await self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
 
-        responses: List[BotPost] = []
-        [responses.append(self._grabber.handle(_)) for _ in subscription_requests]
+        async for post in self._grab_concurrently(subscription_requests):
+            await self._answer(message, post)
 
-        for resp in responses:
-            media = types.MediaGroup()
-            for url in resp.photo_urls:
-                media.attach_photo(url)
-            if resp.photo_urls:
-                await message.answer_media_group(media)
-            await message.answer(resp.text)
-
-    async def listen_message_controller(self, message: types.Message, timerefresh: int = 20):
+    async def listen_message_controller(self, message: types.Message):
         """
-        Responsible for a continuous listening for new subscriptions' posts
-        timerefresh: int period in seconds between services grabbing
+        Subscribes the user to a continuous listening for new subscriptions' posts.
+        Polling itself is done by the shared poller, so the handler returns at once
         """
         assert message.text.startswith('/listen')
+        if self._poller is None and self._listen_registry is None:
+            raise AssertionError('Listening requires a poller or a listen registry')
         user_text: str = message.text
         tg_user_id: int = message.from_user.id
         parsed_commands: Iterable[Alias] = self._parser.parse(user_text)
         subscription_requests: Iterable[SubscriptionRequest] = \
-            self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
-        while True:
-            responses: List[BotPost] = []
-            [responses.append(self._grabber.handle(_)) for _ in subscription_requests]
-
-            for resp in responses:
-                media = types.MediaGroup()
-                for url in resp.photo_urls:
-                    media.attach_photo(url)
-                if resp.photo_urls:
-                    await message.answer_media_group(media)
-                await message.answer(resp.text)
-            await sleep(timerefresh)
+            await self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
+        if self._listen_registry is not None:
+            await self._listen_registry.listen(message.chat.id, subscription_requests)
+            return
+
+        async def deliver(post: BotPost):
+            await self._answer(message, post, SendPriority.LISTEN)
+
+        for subscription_request in subscription_requests:
+            self._poller.subscribe(subscription_request, tg_user_id, deliver)
+
+    async def stop_listen_message_controller(self, message: types.Message):
+        """Unsubscribes the user from the given subscriptions or from all of them if nothing is given"""
+        assert message.text.startswith('/stop')
+        if self._poller is None and self._listen_registry is None:
+            raise AssertionError('Listening requires a poller or a listen registry')
+        user_text: str = message.text
+        tg_user_id: int = message.from_user.id
+        parsed_commands: Iterable[Alias] = list(self._parser.parse(user_text))
+        if not parsed_commands:
+            if self._listen_registry is not None:
+                await self._listen_registry.stop_listening(tg_user_id)
+            else:
+                self._poller.unsubscribe_all(tg_user_id)
+            return
+        subscription_requests: Iterable[SubscriptionRequest] = \
+            await self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
+        if self._listen_registry is not None:
+            await self._listen_registry.stop_listening(tg_user_id, subscription_requests)
+            return
+        for subscription_request in subscription_requests:
+            self._poller.unsubscribe(subscription_request, tg_user_id)
 
     async def all_subscriptions_message_controller(self, message: types.Message):
         """Gets all available subscriptions from db"""
         assert message.text.startswith('/all')
+        if self._pager is not None:
+            await self._answer(message, await self._get_page_post(cursor=None))
+            return
         user_text: str = message.text  # reserved for future options
         tg_user_id: int = message.from_user.id
         parsed_commands: Iterable[Alias] = self._parser.parse(user_text)
         subscription_requests: Iterable[SubscriptionRequest] = \
-            self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
-
-        responses: List[BotPost] = []
-        [responses.append(self._grabber.handle(_)) for _ in subscription_requests]
-
-        for resp in responses:
-            media = types.MediaGroup()
-            for url in resp.photo_urls:
-                media.attach_photo(url)
-            if resp.photo_urls:
-                await message.answer_media_group(media)
-            await message.answer(resp.text)
+            await self._subscription_request_factory.get_subscription_request_pool(parsed_commands, tg_user_id)
+
+        async for post in self._grab_concurrently(subscription_requests):
+            await self._answer(message, post)
+
+    async def all_subscriptions_page_controller(self, callback_query: types.CallbackQuery):
+        """Replaces the page of all subscriptions with the one the pressed button points to"""
+        assert callback_query.data.startswith(ALL_PAGE_PREFIX)
+        if self._pager is None:
+            raise AssertionError('Turning pages requires a pager')
+        cursor: str = callback_query.data[len(ALL_PAGE_PREFIX):]
+        post: BotPost = await self._get_page_post(cursor=cursor or None)
+        await callback_query.message.edit_text(post.text, reply_markup=post.keyboard)
+        await callback_query.answer()
+
+    async def _get_page_post(self, cursor: Optional[str]) -> BotPost:
+        """Makes a post of the page with buttons to the first and to the next pages"""
+        text, next_cursor = await self._pager.get_page(cursor)
+        buttons: List[types.InlineKeyboardButton] = []
+        if cursor is not None:
+            buttons.append(types.InlineKeyboardButton('<< First', callback_data=ALL_PAGE_PREFIX))
+        if next_cursor is not None:
+            buttons.append(types.InlineKeyboardButton('Next >', callback_data=f'{ALL_PAGE_PREFIX}{next_cursor}'))
+        keyboard = types.InlineKeyboardMarkup().row(*buttons) if buttons else None
+        return BotPost(text=text, photo_urls=[], keyboard=keyboard)
 
     _register = {'': message_controller,
                  'listen': listen_message_controller,
-                 'all': all_subscriptions_message_controller, }
+                 'stop': stop_listen_message_controller,
+                 'all': all_subscriptions_message_controller,
+                 'all_page': all_subscriptions_page_controller, }
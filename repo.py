@@ -1,33 +1,127 @@
+import asyncio
+from concurrent.futures import Executor
+from datetime import datetime, timedelta
 from logging import warning
-from typing import Tuple, Set
+from typing import Tuple, Set, Iterable, Dict, Optional, List
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.functions import Mod
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
 
-from domain.message_handlers import AbstractSubscriptionRepo, AbstractAliasRepo
+from domain.message_handlers import (AbstractSubscriptionRepo, AbstractAliasRepo, AbstractLastPostRepo, LastPostKey,
+                                     AbstractProcessedUpdateRepo, AbstractListenRepo, ListenSession,
+                                     AbstractOutboxRepo, OutboxEntry, BotPost, SendPriority,
+                                     AliasResolution)
+from services.sharding import shard_key
+
+
+class AliasIndex:
+    """
+    In-process index of normalized (case-folded) aliases: alias -> (service token, subscription token).
+    Is loaded at binding to the alias model and is rebuilt when aliases, subscriptions or services are saved
+    or deleted within the process. Changes made by other processes (e.g. django admin) are caught by periodic
+    reloading after .start()
+    """
+
+    def __init__(self):
+        self._model: Optional[models.Model] = None
+        self._index: Dict[str, Tuple[str, str]] = {}
+        self._aliases: Set[str] = set()  # as they are stored
+        self._task: Optional[asyncio.Task] = None
+
+    def bind(self, model: models.Model) -> None:
+        """Loads the index from the given alias model and subscribes to changes. Does nothing if already bound"""
+        if self._model is not None:
+            return
+        self._model = model
+        subscription_model = model._meta.get_field('subscription').related_model
+        service_model = subscription_model._meta.get_field('service').related_model
+        for sender in (model, subscription_model, service_model):
+            for signal in (post_save, post_delete):
+                signal.connect(self._on_change, sender=sender, weak=False,
+                               dispatch_uid=f'alias_index_{id(self)}_{sender.__name__}_{id(signal)}')
+        self.load()
+
+    def load(self) -> None:
+        """Rebuilds the whole index with a single query and replaces the current one at once"""
+        rows = self._model.objects.values_list('alias_normalized',
+                                               'alias',
+                                               'subscription__service__service_token',
+                                               'subscription__subscription_token')
+        index: Dict[str, Tuple[str, str]] = {}
+        aliases: Set[str] = set()
+        for alias_normalized, alias, service_token, subscription_token in rows:
+            aliases.add(alias)
+            index[alias_normalized] = service_token, subscription_token
+        self._index, self._aliases = index, aliases
+
+    def get(self, alias: str) -> Optional[Tuple[str, str]]:
+        return self._index.get(self._model.normalize(alias))
+
+    def aliases(self) -> Set[str]:
+        return set(self._aliases)
+
+    def start(self, interval: float = 60., executor: Optional[Executor] = None) -> None:
+        """
+        Reloads the index every interval seconds to catch changes made by other processes.
+        Reloading runs in the given executor (the default one of the loop if None)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(interval, executor))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, interval: float, executor: Optional[Executor]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.get_event_loop().run_in_executor(executor, self.load)
+            except Exception as e:
+                warning(f'Failed to reload aliases: {e!r}')
+
+    def _on_change(self, *args, **kwargs) -> None:
+        self.load()
+
+
+# the index shared by all alias repositories of the process
+alias_index = AliasIndex()
 
 
 class AliasSubscriptionsRepo(AbstractAliasRepo):
-    """Concrete implementation of AbstractAliasRepo"""
+    """Concrete implementation of AbstractAliasRepo. Resolves aliases with in-memory AliasIndex without db queries"""
     model_name: str = 'SubscriptionAlias'
 
-    def __init__(self, model: models.Model):
+    def __init__(self, model: models.Model, index: Optional[AliasIndex] = None):
         self._model = model
+        self._index: AliasIndex = index or alias_index
+        self._index.bind(model)
 
     def get_subscription_info_by(self, alias: str) -> Tuple[str, str]:  # FIXME: consider return type
         """Returns service domain and subscription token by alias"""
         assert isinstance(alias, str)
-        all_aliases = self._model.objects.filter(alias__iexact=alias)
-        if len(all_aliases) > 1:
-            warning(f'Found more then a single match to a given {alias=}: {all_aliases}.')
-        elif len(all_aliases) == 0:
-            assert False, f'Have no such command: {alias}'
-        subscription = all_aliases[0].subscription
-        service = subscription.service
-        return service.service_token, subscription.subscription_token
+        resolution: AliasResolution = self.get_subscriptions_info_by([alias])
+        assert not resolution.unknown, f'Have no such command: {alias}'
+        return resolution.resolved[alias]
+
+    def get_subscriptions_info_by(self, aliases: Iterable[str]) -> AliasResolution:
+        """Resolves all the given aliases case-insensitively"""
+        resolved: Dict[str, Tuple[str, str]] = {}
+        unknown: List[str] = []
+        for alias in aliases:
+            info: Optional[Tuple[str, str]] = self._index.get(alias)
+            if info is None:
+                unknown.append(alias)
+            else:
+                resolved[alias] = info
+        return AliasResolution(resolved=resolved, unknown=unknown)
 
     def all_aliases_as_set(self) -> Set[str]:
         """Return all stored aliases as set"""
-        return {_.alias for _ in self._model.objects.all()}
+        return self._index.aliases()
 
 
 class SubscriptionRepo(AbstractSubscriptionRepo):
@@ -39,3 +133,190 @@ class SubscriptionRepo(AbstractSubscriptionRepo):
 
     def get_all_subscriptions_as_set(self) -> Set[str]:
         return {_.subscription_token for _ in self._model.objects.all()}
+
+    def get_subscriptions_page(self, after: Optional[int], limit: int) -> List[Tuple[int, str]]:
+        """Keyset pagination by primary key. Reads only the requested page however many subscriptions there are"""
+        queryset = self._model.objects.order_by('id')
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        return list(queryset.values_list('id', 'subscription_token')[:limit])
+
+
+class LastPostRepo(AbstractLastPostRepo):
+    """Repository responsible for managing LastPostForUser django model"""
+    model_name = 'LastPostForUser'
+
+    def __init__(self, model: models.Model):
+        self._model = model
+        self._user_model = model._meta.get_field('telegram_user').related_model
+        self._subscription_model = model._meta.get_field('subscription').related_model
+
+    def _filter_by(self, keys: Set[LastPostKey]) -> models.QuerySet:
+        return self._model.objects.filter(telegram_user__telegram_id__in={_[0] for _ in keys},
+                                          subscription__subscription_token__in={_[1] for _ in keys})
+
+    def _get_ids(self, keys: Iterable[LastPostKey]) -> Tuple[Dict[int, int], Dict[str, int]]:
+        """Returns db ids of telegram users and of subscriptions of the keys creating absent users"""
+        keys: Set[LastPostKey] = set(keys)
+        tg_user_ids: Set[int] = {_[0] for _ in keys}
+        self._user_model.objects.bulk_create([self._user_model(telegram_id=_) for _ in tg_user_ids],
+                                             ignore_conflicts=True)
+        users: Dict[int, int] = dict(self._user_model.objects.filter(telegram_id__in=tg_user_ids)
+                                     .values_list('telegram_id', 'id'))
+        subscriptions: Dict[str, int] = dict(self._subscription_model.objects
+                                             .filter(subscription_token__in={_[1] for _ in keys})
+                                             .values_list('subscription_token', 'id'))
+        return users, subscriptions
+
+    def get_last_post_ids(self, keys: Iterable[LastPostKey]) -> Dict[LastPostKey, Optional[str]]:
+        """Returns the last delivered post id for each of given keys which is stored. Makes a single query"""
+        keys: Set[LastPostKey] = set(keys)
+        if not keys:
+            return {}
+        rows = self._filter_by(keys).values_list('telegram_user__telegram_id',
+                                                 'subscription__subscription_token',
+                                                 'last_post_id')
+        return {(user, subscription): post_id for user, subscription, post_id in rows
+                if (user, subscription) in keys}
+
+    def update_last_post_ids(self, last_post_ids: Dict[LastPostKey, str]) -> None:
+        """
+        Stores the last delivered post ids with a single upsert on (telegram_user, subscription)
+        creating absent telegram users beforehand"""
+        if not last_post_ids:
+            return
+        with transaction.atomic():
+            users, subscriptions = self._get_ids(last_post_ids)
+            rows = []
+            for (tg_user_id, subscription_token), post_id in last_post_ids.items():
+                if subscription_token not in subscriptions:
+                    warning(f'Can\'t store the last post for unknown subscription: {subscription_token}')
+                    continue
+                rows.append(self._model(telegram_user_id=users[tg_user_id],
+                                        subscription_id=subscriptions[subscription_token],
+                                        last_post_id=post_id))
+            self._model.objects.bulk_create(rows,
+                                            update_conflicts=True,
+                                            unique_fields=['telegram_user', 'subscription'],
+                                            update_fields=['last_post_id'])
+
+
+class ListenRepo(LastPostRepo, AbstractListenRepo):
+    """Repository responsible for managing listening of LastPostForUser django model"""
+    model_name = 'LastPostForUser'
+
+    def listen(self, sessions: Iterable[ListenSession]) -> None:
+        """Stores the sessions with a single upsert on (telegram_user, subscription) keeping known last post ids"""
+        sessions: List[ListenSession] = list(sessions)
+        if not sessions:
+            return
+        now = timezone.now()
+        with transaction.atomic():
+            users, subscriptions = self._get_ids((_.tg_user_id, _.subscription_token) for _ in sessions)
+            rows = []
+            for session in sessions:
+                if session.subscription_token not in subscriptions:
+                    warning(f'Can\'t listen to unknown subscription: {session.subscription_token}')
+                    continue
+                rows.append(self._model(telegram_user_id=users[session.tg_user_id],
+                                        subscription_id=subscriptions[session.subscription_token],
+                                        last_post_id=session.last_post_id,
+                                        listening=True,
+                                        chat_id=session.chat_id,
+                                        shard_key=shard_key(session.subscription_token),
+                                        listen_changed_at=now))
+            self._model.objects.bulk_create(rows,
+                                            update_conflicts=True,
+                                            unique_fields=['telegram_user', 'subscription'],
+                                            update_fields=['listening', 'chat_id', 'shard_key', 'listen_changed_at'])
+
+    def stop_listening(self, tg_user_id: int, subscription_tokens: Optional[Iterable[str]] = None) -> None:
+        listening: models.QuerySet = self._model.objects.filter(telegram_user__telegram_id=tg_user_id, listening=True)
+        if subscription_tokens is not None:
+            listening = listening.filter(subscription__subscription_token__in=set(subscription_tokens))
+        listening.update(listening=False, listen_changed_at=timezone.now())
+
+    def get_listen_sessions_page(self, after: Optional[int], limit: int,
+                                 shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, ListenSession]]:
+        """Pages by id, so sessions added or stopped meanwhile don't shift the pages"""
+        return self._get_sessions_page(self._model.objects.filter(listening=True), after, limit, shard)
+
+    def get_listen_changes_page(self, since: datetime, after: Optional[int], limit: int,
+                                shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, ListenSession]]:
+        return self._get_sessions_page(self._model.objects.filter(listen_changed_at__gte=since), after, limit, shard)
+
+    @staticmethod
+    def _get_sessions_page(sessions: models.QuerySet, after: Optional[int], limit: int,
+                           shard: Optional[Tuple[int, int]]) -> List[Tuple[int, ListenSession]]:
+        if shard is not None:
+            index, count = shard
+            sessions = sessions.annotate(shard=Mod('shard_key', count)).filter(shard=index)
+        if after is not None:
+            sessions = sessions.filter(id__gt=after)
+        rows = sessions.order_by('id').values_list('id',
+                                                   'subscription__service__service_token',
+                                                   'subscription__subscription_token',
+                                                   'telegram_user__telegram_id',
+                                                   'chat_id',
+                                                   'last_post_id',
+                                                   'listening')[:limit]
+        return [(row_id, ListenSession(service, subscription_token, tg_user_id, chat_id, last_post_id, listening))
+                for row_id, service, subscription_token, tg_user_id, chat_id, last_post_id, listening in rows]
+
+
+class OutboxRepo(AbstractOutboxRepo):
+    """Repository responsible for managing OutboxPost django model"""
+    model_name = 'OutboxPost'
+
+    def __init__(self, model: models.Model):
+        self._model = model
+
+    def put(self, entries: Iterable[OutboxEntry]) -> None:
+        self._model.objects.bulk_create([self._model(chat_id=_.chat_id,
+                                                     priority=int(_.priority),
+                                                     text=_.post.text,
+                                                     photo_urls=_.post.photo_urls,
+                                                     post_id=_.post.post_id) for _ in entries])
+
+    def claim(self, claimer: str, limit: int, lease: float) -> List[OutboxEntry]:
+        """
+        Marks the entries with the claimer by an update which skips entries claimed meanwhile,
+        so concurrent claimers get different entries
+        """
+        now = timezone.now()
+        claimable = models.Q(claimed_by__isnull=True) | models.Q(claimed_at__lt=now - timedelta(seconds=lease))
+        with transaction.atomic():
+            ids: List[int] = list(self._model.objects.filter(claimable).order_by('id')
+                                  .values_list('id', flat=True)[:limit])
+            if not ids:
+                return []
+            self._model.objects.filter(claimable, id__in=ids).update(claimed_by=claimer, claimed_at=now)
+            rows = list(self._model.objects.filter(id__in=ids, claimed_by=claimer, claimed_at=now).order_by('id')
+                        .values_list('id', 'chat_id', 'priority', 'text', 'photo_urls', 'post_id'))
+        return [OutboxEntry(chat_id, BotPost(text, photo_urls, post_id=post_id), SendPriority(priority), entry_id)
+                for entry_id, chat_id, priority, text, photo_urls, post_id in rows]
+
+    def delete(self, entry_ids: Iterable[int]) -> None:
+        self._model.objects.filter(id__in=list(entry_ids)).delete()
+
+
+class ProcessedUpdateRepo(AbstractProcessedUpdateRepo):
+    """Repository responsible for managing ProcessedUpdate django model"""
+    model_name = 'ProcessedUpdate'
+
+    def __init__(self, model: models.Model):
+        self._model = model
+
+    def mark_processed(self, update_id: int) -> bool:
+        """Inserts the update with a single query. The primary key makes concurrent workers agree on the first one"""
+        try:
+            with transaction.atomic():
+                self._model.objects.create(update_id=update_id)
+        except IntegrityError:
+            return False
+        return True
+
+    def forget_processed_before(self, seconds: float) -> int:
+        deleted, _ = self._model.objects.filter(
+            processed_at__lt=timezone.now() - timedelta(seconds=seconds)).delete()
+        return deleted
@@ -0,0 +1,59 @@
+import asyncio
+from logging import warning
+from typing import List, Tuple, Callable, Awaitable, Optional
+
+from domain.message_handlers import SubscriptionRequest, JSONType
+from services.query_strategies import BatchQueryStrategy
+
+# Coroutine function requesting a query and returning decoded response with its size in bytes
+Fetcher = Callable[[str], Awaitable[Tuple[JSONType, int]]]
+
+
+class QueryBatcher:
+    """
+    Collects subscription requests of a batching strategy made within a short window and queries them
+    with a single request. Callers just await .query() as if the request was made on its own
+    """
+
+    def __init__(self, strategy: BatchQueryStrategy, fetch: Fetcher, window: float = 0.01):
+        """window: float seconds to wait for more requests after the first one of a batch"""
+        self._strategy = strategy
+        self._fetch = fetch
+        self._window = window
+        self._pending: List[Tuple[SubscriptionRequest, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def query(self, subscription_request: SubscriptionRequest) -> Tuple[JSONType, int]:
+        loop = asyncio.get_event_loop()
+        future: asyncio.Future = loop.create_future()
+        self._pending.append((subscription_request, future))
+        if len(self._pending) >= self._strategy.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[SubscriptionRequest, asyncio.Future]]) -> None:
+        requests: List[SubscriptionRequest] = [_[0] for _ in batch]
+        try:
+            if len(requests) == 1:
+                results: List[Tuple[JSONType, int]] = [await self._fetch(self._strategy.get_query(requests[0]))]
+            else:
+                data, size = await self._fetch(self._strategy.get_batch_query(requests))
+                split: List[JSONType] = self._strategy.split_batch_response(data, requests)
+                if len(split) != len(requests):
+                    raise ValueError(f'Batch response has {len(split)} results for {len(requests)} requests')
+                results = [(_, size // len(requests)) for _ in split]
+        except Exception as e:
+            warning(f'Failed to query a batch of {len(requests)} requests: {e!r}')
+            [future.set_exception(e) for _, future in batch if not future.done()]
+        else:
+            [future.set_result(result) for (_, future), result in zip(batch, results) if not future.done()]
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Callable, Awaitable, Tuple, Any, Hashable, TypeVar
+
+try:  # orjson of the requirements serializes several times faster, json is the fallback
+    from orjson import dumps as _orjson_dumps, OPT_SORT_KEYS
+
+    def canonical_json(value: Any) -> bytes:
+        """Serializes the value the same way no matter the order of keys"""
+        return _orjson_dumps(value, option=OPT_SORT_KEYS)
+except ImportError:
+    from json import dumps as _json_dumps
+
+    def canonical_json(value: Any) -> bytes:
+        """Serializes the value the same way no matter the order of keys"""
+        return _json_dumps(value, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode()
+
+from domain.message_handlers import JSONType
+
+# Coroutine function which loads a value and returns it along with its size in bytes
+Loader = Callable[[], Awaitable[Tuple[JSONType, int]]]
+
+_T = TypeVar('_T')
+
+
+@dataclass
+class _CacheEntry:
+    value: JSONType
+    size: int  # bytes
+    expires_at: float  # time.monotonic()
+
+
+class TTLResponseCache:
+    """
+    Process-wide LRU cache of services' responses with TTL per service and a memory cap.
+    Concurrent misses of the same key share a single load. Use .get_or_load() in front of querying.
+    Expired responses are kept until evicted, so .get_stale() can answer while the service is failing
+    """
+
+    def __init__(self,
+                 ttls: Optional[Dict[str, float]] = None,
+                 default_ttl: float = 10.,
+                 max_entries: int = 1024,
+                 max_bytes: int = 32 * 2 ** 20,
+                 is_cacheable: Optional[Callable[[JSONType], bool]] = None,
+                 max_stale: float = 600.):
+        """
+        ttls: Dict[str, float] seconds to keep responses of a service. default_ttl is used for others
+        max_entries: int, max_bytes: int the least recently used responses are evicted beyond these limits
+        is_cacheable: Callable if given, responses it returns False for (e.g. errors) aren't stored
+        max_stale: float seconds after expiring a response is still given by .get_stale()
+        """
+        self._ttls: Dict[str, float] = ttls or {}
+        self._default_ttl = default_ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._is_cacheable = is_cacheable
+        self._max_stale = max_stale
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0  # misses which waited for a load started by another caller
+        self.stale_hits: int = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'stale_hits': self.stale_hits,
+                'entries': len(self._entries), 'bytes': self._bytes}
+
+    async def get_or_load(self, service: Optional[str], key: str, loader: Loader) -> JSONType:
+        """Returns fresh cached value by key or loads it once no matter how many callers are waiting"""
+        entry: Optional[_CacheEntry] = self._entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+        if key in self._in_flight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task: asyncio.Task = asyncio.ensure_future(self._load(service, key, loader))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._on_loaded(key, _))
+        # the load goes on for other waiters if this caller is cancelled
+        return await asyncio.shield(self._in_flight[key])
+
+    def get_stale(self, key: str) -> Optional[JSONType]:
+        """Returns the value by key even if it has expired not longer than max_stale ago"""
+        entry: Optional[_CacheEntry] = self._entries.get(key)
+        if entry is None or entry.expires_at + self._max_stale <= time.monotonic():
+            return None
+        self.stale_hits += 1
+        return entry.value
+
+    def invalidate(self, key: str) -> None:
+        self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _on_loaded(self, key: str, task: asyncio.Task) -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # is raised to waiters. Retrieved here in case all of them have been cancelled
+
+    async def _load(self, service: Optional[str], key: str, loader: Loader) -> JSONType:
+        value, size = await loader()
+        if self._is_cacheable is None or self._is_cacheable(value):
+            self._store(key, _CacheEntry(value, size, time.monotonic() + self._ttls.get(service, self._default_ttl)))
+        return value
+
+    def _store(self, key: str, entry: _CacheEntry) -> None:
+        if entry.size > self._max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        entry: Optional[_CacheEntry] = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+
+class RenderedPostCache:
+    """
+    Process-wide LRU cache of what represent strategies made of a post. Keys are a strategy's namespace and a hash
+    of the post's values the strategy reads, so a post polled again or asked for by many users is represented once.
+    Is safe to use from threads representing out of the event loop
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[Tuple[Hashable, bytes], Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def get_or_represent(self, namespace: Hashable, content: JSONType, represent: Callable[[], _T]) -> _T:
+        """Returns what represent made of the same content in the namespace before or calls it"""
+        key: Tuple[Hashable, bytes] = (namespace, hashlib.blake2b(canonical_json(content), digest_size=16).digest())
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value: _T = represent()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,273 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from dataclasses import dataclass, field
+from logging import warning
+from typing import Dict, List, Callable, Awaitable, Optional, Any, Tuple, Deque
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter
+
+from domain.message_handlers import BotPost, SendPriority
+from services.metrics import registry
+
+CAPTION_LIMIT = 1024  # telegram limit of a media caption length
+MEDIA_GROUP_LIMIT = 10  # telegram limit of photos in a single media group
+CHAT_BUCKETS_LIMIT = 10_000  # idle limits of chats without queued posts are forgotten beyond this number
+
+# A single call of telegram bot api
+ApiCall = Callable[[], Awaitable[Any]]
+
+SEND_SECONDS = registry.histogram('huddle_send_seconds', 'Time from queueing posts to sending them to a chat',
+                                  ['priority'])
+TELEGRAM_CALL_SECONDS = registry.histogram('huddle_telegram_call_seconds', 'Time of a single telegram api call')
+TELEGRAM_FLOOD_WAITS = registry.counter('huddle_telegram_flood_waits_total', 'Calls telegram asked to retry later')
+SEND_FAILURES = registry.counter('huddle_send_failures_total', 'Posts which failed to be sent', ['priority'])
+
+
+class TokenBucket:
+    """Lets through rate calls per second on average with bursts up to capacity calls"""
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens: float = capacity
+        self._updated_at: float = asyncio.get_event_loop().time()
+        self._blocked_until: float = 0.
+
+    @property
+    def is_idle(self) -> bool:
+        """Is full and not blocked, so forgetting it changes nothing"""
+        self._refill()
+        return self._tokens >= self._capacity and asyncio.get_event_loop().time() >= self._blocked_until
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            self._refill()
+            now: float = loop.time()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+            elif self._tokens >= 1:
+                self._tokens -= 1
+                return
+            else:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def try_acquire(self) -> float:
+        """Takes a call if it's let through now and returns 0. Otherwise returns seconds to wait before trying again"""
+        self._refill()
+        now: float = asyncio.get_event_loop().time()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.
+        return (1 - self._tokens) / self._rate
+
+    def block(self, seconds: float) -> None:
+        """Lets nothing through for the given seconds. Used when telegram asks to retry after"""
+        self._blocked_until = max(self._blocked_until, asyncio.get_event_loop().time() + seconds)
+        self._tokens = 0.
+
+    def _refill(self) -> None:
+        now: float = asyncio.get_event_loop().time()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+@dataclass(order=True)
+class _SendJob:
+    priority: int
+    sequence: int  # keeps FIFO order within the same priority
+    chat_id: int = field(compare=False)
+    posts: List[BotPost] = field(compare=False)
+    done: asyncio.Future = field(compare=False)
+    queued_at: float = field(compare=False, default=0.)  # loop time
+
+
+@dataclass
+class _ChatQueue:
+    jobs: List[_SendJob]  # heap of jobs waiting for the current one
+    job: Optional[_SendJob] = None  # the job being sent
+    calls: Deque[ApiCall] = field(default_factory=deque)  # calls of the current job left to be made
+    attempts: int = 0  # flood control errors of the current call
+
+
+class OutboundDispatcher:
+    """
+    Central queue of BotPosts to be sent to telegram chats. Sends keeping global and per chat rate limits,
+    interactive replies go ahead of listen pushes, flood control errors delay the chat and the call is retried.
+    Each chat has its own queue and workers make a single call of a chat only when the chat's limit lets it through,
+    so a chat waiting for its limit doesn't hold up workers and other chats.
+    Post's text is merged into media caption when it fits, so such a post costs a single api call.
+    Use .start()/.stop() along with the bot
+    """
+
+    def __init__(self, bot: Bot,
+                 workers: int = 8,
+                 global_rate: float = 30.,
+                 chat_rate: float = 1.,
+                 chat_burst: float = 3.,
+                 max_retries: int = 3):
+        """
+        global_rate: float api calls per second for the whole bot
+        chat_rate: float, chat_burst: float api calls per second to a single chat and the most of them at once
+        max_retries: int how many times a call is retried after flood control error
+        """
+        self._bot = bot
+        self._workers_number = workers
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._chats: Dict[int, _ChatQueue] = {}  # chats having posts to be sent
+        self._ready: List[Tuple[int, int, int]] = []  # heap of (priority, sequence, chat_id) which may be served
+        self._waiting: List[Tuple[float, int]] = []  # heap of (loop time, chat_id) waiting for the chat's limit
+        self._wakeup = asyncio.Event()
+        self._sequence = itertools.count()
+        self._queued: int = 0
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def queue_size(self) -> int:
+        return self._queued
+
+    def submit(self, chat_id: int, posts: List[BotPost], priority: SendPriority) -> asyncio.Future:
+        """Puts posts to the queue. They are sent one by one in the given order. Returns future of sending"""
+        loop = asyncio.get_event_loop()
+        done: asyncio.Future = loop.create_future()
+        job = _SendJob(int(priority), next(self._sequence), chat_id, list(posts), done, loop.time())
+        self._queued += 1
+        if chat_id in self._chats:  # the chat is already scheduled
+            heapq.heappush(self._chats[chat_id].jobs, job)
+        else:
+            self._chats[chat_id] = _ChatQueue(jobs=[job])
+            self._schedule(chat_id)
+        return done
+
+    async def send(self, chat_id: int, posts: List[BotPost], priority: SendPriority) -> None:
+        """Puts posts to the queue and waits until they are sent"""
+        await self.submit(chat_id, posts, priority)
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(self._workers_number)]
+
+    async def stop(self) -> None:
+        [worker.cancel() for worker in self._workers]
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _schedule(self, chat_id: int) -> None:
+        """Lets workers serve the chat by its most urgent job"""
+        chat: _ChatQueue = self._chats[chat_id]
+        head: _SendJob = chat.job or chat.jobs[0]
+        heapq.heappush(self._ready, (head.priority, head.sequence, chat_id))
+        self._wakeup.set()
+
+    async def _next_chat(self) -> int:
+        """Waits for a chat which has a job and whose limit lets a call through. The call is taken of the limit"""
+        loop = asyncio.get_event_loop()
+        while True:
+            now: float = loop.time()
+            while self._waiting and self._waiting[0][0] <= now:
+                self._schedule(heapq.heappop(self._waiting)[1])
+            while self._ready:
+                chat_id: int = heapq.heappop(self._ready)[2]
+                delay: float = self._chat_bucket(chat_id).try_acquire()
+                if not delay:
+                    return chat_id
+                heapq.heappush(self._waiting, (now + delay, chat_id))
+            self._wakeup.clear()
+            timeout: Optional[float] = self._waiting[0][0] - now if self._waiting else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self) -> None:
+        while True:
+            chat_id: int = await self._next_chat()
+            chat: _ChatQueue = self._chats[chat_id]
+            if chat.job is None:
+                chat.job = heapq.heappop(chat.jobs)
+                chat.calls = deque(call for post in chat.job.posts for call in self._calls_for(chat_id, post))
+                chat.attempts = 0
+            job: _SendJob = chat.job
+            try:
+                if chat.calls:
+                    await self._global_bucket.acquire()
+                    with TELEGRAM_CALL_SECONDS.time():
+                        await chat.calls[0]()
+                    chat.calls.popleft()
+                    chat.attempts = 0
+            except asyncio.CancelledError:
+                job.done.cancel()
+                raise
+            except RetryAfter as e:
+                TELEGRAM_FLOOD_WAITS.inc()
+                chat.attempts += 1
+                if chat.attempts > self._max_retries:
+                    self._finish(chat, e)
+                else:
+                    warning(f'Flood control for chat {chat_id}: retry in {e.timeout}s')
+                    self._chat_bucket(chat_id).block(e.timeout)
+            except Exception as e:
+                self._finish(chat, e)
+            else:
+                if not chat.calls:
+                    self._finish(chat)
+            if chat.job is None and not chat.jobs:
+                del self._chats[chat_id]
+            else:
+                self._schedule(chat_id)
+
+    def _finish(self, chat: _ChatQueue, error: Optional[Exception] = None) -> None:
+        """Completes the chat's current job with the error if it has failed"""
+        job: _SendJob = chat.job
+        chat.job, chat.calls = None, deque()
+        self._queued -= 1
+        priority: str = SendPriority(job.priority).name.lower()
+        if error is not None:
+            SEND_FAILURES.inc(len(job.posts), priority=priority)
+            warning(f'Failed to send to chat {job.chat_id}: {error!r}')
+            if not job.done.done():
+                job.done.set_exception(error)
+            return
+        SEND_SECONDS.observe(asyncio.get_event_loop().time() - job.queued_at, priority=priority)
+        if not job.done.done():
+            job.done.set_result(None)
+
+    def _calls_for(self, chat_id: int, post: BotPost) -> List[ApiCall]:
+        """Splits a post into api calls merging the text into the caption where it is allowed"""
+        calls: List[ApiCall] = []
+        chunks: List[List[str]] = [post.photo_urls[_:_ + MEDIA_GROUP_LIMIT]
+                                   for _ in range(0, len(post.photo_urls), MEDIA_GROUP_LIMIT)]
+        # media groups can't have a keyboard, so the text with keyboard is merged only into a single photo
+        can_merge: bool = bool(post.text) and len(post.text) <= CAPTION_LIMIT and bool(chunks) \
+            and (post.keyboard is None or (len(chunks) == 1 and len(chunks[0]) == 1))
+        for index, chunk in enumerate(chunks):
+            caption: Optional[str] = post.text if can_merge and index == 0 else None
+            if len(chunk) == 1:
+                calls.append(lambda url=chunk[0], text=caption:
+                             self._bot.send_photo(chat_id, url, caption=text,
+                                                  reply_markup=post.keyboard if text else None))
+            else:
+                media = types.MediaGroup()
+                for url_index, url in enumerate(chunk):
+                    media.attach_photo(url, caption=caption if url_index == 0 else None)
+                calls.append(lambda media=media: self._bot.send_media_group(chat_id, media))
+        if post.text and not can_merge:
+            calls.append(lambda: self._bot.send_message(chat_id, post.text, reply_markup=post.keyboard))
+        return calls
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self._chat_buckets:
+            if len(self._chat_buckets) > CHAT_BUCKETS_LIMIT:  # forgets chats which have been quiet long enough
+                self._chat_buckets = {k: v for k, v in self._chat_buckets.items()
+                                      if not v.is_idle or k in self._chats}
+            self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return self._chat_buckets[chat_id]
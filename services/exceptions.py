@@ -6,9 +6,21 @@ class VKBadRequestException(BaseVKException):
     """Raises when vk api responses with error"""
 
 
+class VKTransientException(VKBadRequestException):
+    """Raises when vk api responses with error which is expected to go away: flood control, internal error etc."""
+
+
 class VKNonRegularPostResponse(BaseVKException):
     """Raises when can't parse milongas inside valid milonga response"""
 
 
 class NotAppropriateContent(BaseVKException):
     """Raises when can't parse appropriate content inside valid post"""
+
+
+class ServiceUnavailableException(Exception):
+    """Raises when a service can't answer now: it times out, fails or keeps responding with transient errors"""
+
+
+class CircuitOpenException(ServiceUnavailableException):
+    """Raises when a service or a subscription isn't queried since it has been failing recently"""
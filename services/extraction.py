@@ -0,0 +1,155 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Returns the value found by a compiled path. Raises KeyError, IndexError or TypeError if there is no such value
+Accessor = Callable[[Any], Any]
+
+# Builds the text of a post from its text and extra fields of the spec
+Renderer = Callable[[str, Dict[str, Any]], str]
+
+# Returns a copy of a decoded json keeping only the values some paths need
+Pruner = Callable[[Any], Any]
+
+# Keys needed of a dict, '*' stands for every element of a list. True means the whole value is needed
+_PathTree = Dict[str, Any]
+
+_STEP = re.compile(r'([^.\[\]]+)|\[(-?\d+|\*)\]')
+
+# Cost hints of representing. Tell the grabber where posts are represented: on the event loop, in a thread or in
+# a process pool. A heavier hint keeps big payloads from holding up the loop at the price of handing them over
+INLINE, THREAD, PROCESS = 'inline', 'thread', 'process'
+
+
+@dataclass(frozen=True)
+class ExtractionSpec:
+    """
+    Declares where a post's content is inside a service's post item.
+    Paths are keys separated by dots with list indexes in brackets, e.g. `attachments[0].poll.answers`.
+    `[*]` takes the rest of the path from every element of a list skipping elements which don't have it
+    """
+    text: str = 'text'  # path to the text of the post
+    photo_urls: Optional[str] = None  # path to urls of attached photos
+    repost: Optional[str] = None  # path to the original post. If it exists, text and photos are taken from it
+    no_text: str = '_Post text is unavailable_'  # replaces empty text
+    no_result_text: str = 'No result. See terminal log.'  # answers a user when posts can't be represented
+    required_phrases: Tuple[str, ...] = ()  # posts which text lacks any of them aren't appropriate
+    fields: Dict[str, str] = field(default_factory=dict)  # extra paths given to render by name
+    render: Optional[Renderer] = None  # builds the text of the post, the text path is used as is otherwise
+    cost: str = INLINE  # cost hint of representing posts of the spec
+
+
+def _parse_path(path: str) -> List[Tuple[str, bool]]:
+    steps: List[Tuple[str, bool]] = []  # (key or index, is index)
+    position = 0
+    for match in _STEP.finditer(path):
+        separator: str = '.' if match.group(1) and position else ''  # keys are separated by dots, indexes aren't
+        if path[position:match.start()] != separator:
+            raise ValueError(f'Wrong path: {path}')
+        steps.append((match.group(1), False) if match.group(1) else (match.group(2), True))
+        position = match.end()
+    if not steps or position != len(path):
+        raise ValueError(f'Wrong path: {path}')
+    return steps
+
+
+def compile_path(path: str) -> Accessor:
+    """Turns a path into a function which finds the value inside a decoded json"""
+    steps: List[Tuple[str, bool]] = _parse_path(path)
+    # built from the end of the path, so each step is a single closure call
+    accessor: Accessor = lambda value: value
+    for step, is_index in reversed(steps):
+        accessor = _compile_step(step, is_index, accessor)
+    return accessor
+
+
+def _compile_step(step: str, is_index: bool, rest: Accessor) -> Accessor:
+    if step == '*':
+        def each(value: Any) -> List[Any]:
+            found: List[Any] = []
+            for element in value:
+                try:
+                    found.append(rest(element))
+                except (KeyError, IndexError, TypeError):
+                    continue
+            return found
+        return each
+    key = int(step) if is_index else step
+    return lambda value: rest(value[key])
+
+
+def compile_pruner(paths: List[str]) -> Pruner:
+    """
+    Turns paths into a function copying only the values they need out of a decoded json.
+    Indexes keep every element of a list, so the pruned value is read by the same paths
+    """
+    tree: _PathTree = {}
+    for path in paths:
+        node: _PathTree = tree
+        steps: List[Tuple[str, bool]] = _parse_path(path)
+        for position, (step, is_index) in enumerate(steps):
+            key: str = '*' if is_index else step
+            if node.get(key) is True:
+                break
+            if position == len(steps) - 1:
+                node[key] = True
+            else:
+                node = node.setdefault(key, {})
+    return _compile_tree(tree)
+
+
+def _compile_tree(tree: _PathTree) -> Pruner:
+    children: Dict[str, Pruner] = {key: (lambda value: value) if subtree is True else _compile_tree(subtree)
+                                   for key, subtree in tree.items()}
+    each: Optional[Pruner] = children.pop('*', None)
+
+    def prune(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {key: child(value[key]) for key, child in children.items() if key in value}
+        if isinstance(value, list) and each is not None:
+            return [each(_) for _ in value]
+        return value
+    return prune
+
+
+class CompiledSpec:
+    """ExtractionSpec with paths compiled once into accessors and a pruner of values it doesn't need"""
+    item_paths: Tuple[str, ...] = ('id', 'date', 'is_pinned')  # are needed of every post besides its content
+
+    def __init__(self, spec: ExtractionSpec):
+        self.spec = spec
+        self._text: Accessor = compile_path(spec.text)
+        self._photo_urls: Optional[Accessor] = compile_path(spec.photo_urls) if spec.photo_urls else None
+        self._repost: Optional[Accessor] = compile_path(spec.repost) if spec.repost else None
+        self._fields: Dict[str, Accessor] = {name: compile_path(path) for name, path in spec.fields.items()}
+        # a post is read either by itself or through its repost path, so both ways are kept
+        content_paths: List[str] = [spec.text, *filter(None, [spec.photo_urls]), *spec.fields.values()]
+        repost_paths: List[str] = [f'{spec.repost}{"" if _.startswith("[") else "."}{_}' for _ in content_paths] \
+            if spec.repost else []
+        self.prune: Pruner = compile_pruner([*self.item_paths, *content_paths, *repost_paths])
+
+    def source_of(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the original post of a repost or the post itself"""
+        if self._repost is None:
+            return item
+        try:
+            return self._repost(item)
+        except (KeyError, IndexError, TypeError):
+            return item
+
+    def text(self, item: Dict[str, Any]) -> str:
+        """Raises KeyError, IndexError, TypeError if the post lacks required values"""
+        source: Dict[str, Any] = self.source_of(item)
+        text: str = self._text(source) or self.spec.no_text
+        if self.spec.render is not None:
+            text = self.spec.render(text, {name: accessor(source) for name, accessor in self._fields.items()})
+        return text
+
+    def photo_urls(self, item: Dict[str, Any]) -> List[str]:
+        if self._photo_urls is None:
+            return []
+        found: Any = self._photo_urls(self.source_of(item))
+        return found if isinstance(found, list) else [found]
+
+    def is_appropriate(self, text: str) -> bool:
+        return all(_ in text for _ in self.spec.required_phrases)
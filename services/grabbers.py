@@ -1,46 +1,195 @@
-from typing import Type
+import asyncio
+from concurrent.futures import Executor
+from logging import warning
+from typing import Type, Optional, Tuple, Dict, List
 
-import requests
+import aiohttp
+
+try:  # orjson of the requirements decodes several times faster, json is the fallback
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    from json import loads as json_loads, dumps as json_dumps
 
 from domain.message_handlers import SubscriptionRequest, BotPost, JSONType
-from services.query_strategies import QueryStrategy
+from services.batchers import QueryBatcher
+from services.caches import TTLResponseCache, Loader
+from services.exceptions import ServiceUnavailableException
+from services.extraction import INLINE, THREAD
+from services.metrics import registry
+from services.query_strategies import QueryStrategy, BatchQueryStrategy
 from services.represent_strategies import RepresentStrategy
+from services.resilience import ResilientCaller
+from services.sessions import HTTPSessionPool, default_session_pool
 from services.strategy_registers import QueryStrategyRegister, RepresentStrategyRegister
 
+QUERY_SECONDS = registry.histogram('huddle_query_seconds', 'Time of getting a response including the cache',
+                                   ['service'])
+REPRESENT_SECONDS = registry.histogram('huddle_represent_seconds', 'Time of representing a response as posts',
+                                       ['service'])
+STALE_ANSWERS = registry.counter('huddle_stale_answers_total', 'Responses answered from the cache after expiring',
+                                 ['service'])
+OFFLOADED_CALLS = registry.counter('huddle_offloaded_calls_total', 'Work run out of the event loop by cost hint',
+                                   ['work', 'cost'])
+
+
+def _represent_by(represent_strategy_register: Type[RepresentStrategyRegister],
+                  subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
+    """
+    Represents data with the registered strategy. Is given to process pools instead of the strategy itself,
+    since compiled strategies can't be pickled. A worker process finds the strategy in its copy of the register
+    """
+    return represent_strategy_register.get_strategy_by(subscription_request).represent(subscription_request, data)
+
 
 class Grabber:
     def __init__(self, query_strategy_register: Type[QueryStrategyRegister],
-                 represent_strategy_register: Type[RepresentStrategyRegister]):
+                 represent_strategy_register: Type[RepresentStrategyRegister],
+                 session_pool: Optional[HTTPSessionPool] = None,
+                 cache: Optional[TTLResponseCache] = None,
+                 batch_window: Optional[float] = 0.01,
+                 resilience: Optional[ResilientCaller] = None,
+                 prune: bool = True,
+                 executors: Optional[Dict[str, Executor]] = None,
+                 offload_decoding_from: Optional[int] = None):
+        """
+        cache: TTLResponseCache if given, responses for the same query are shared while they are fresh
+        and an expired one answers while the service is unavailable
+        batch_window: float seconds to collect concurrent requests of a batching strategy into a single query.
+        None disables batching
+        resilience: ResilientCaller if given, failing queries are retried and failing services aren't queried
+        prune: bool if True, only the values the represent strategy reads are kept of a decoded response
+        executors: Dict of executors by cost hints of services.extraction. Posts of a strategy which cost hint has
+        an executor are represented in it, others are represented on the event loop
+        offload_decoding_from: int if given, responses of at least these bytes are decoded in the THREAD executor.
+        The event loop keeps turning meanwhile at the interpreter's switch interval
+        """
         self._query_strategy_register = query_strategy_register
         self._represent_strategy_register = represent_strategy_register
+        self._session_pool: HTTPSessionPool = session_pool or default_session_pool
+        self._cache: Optional[TTLResponseCache] = cache
+        self._batch_window: Optional[float] = batch_window
+        self._batchers: Dict[type, QueryBatcher] = {}
+        self._resilience: Optional[ResilientCaller] = resilience
+        self._prune = prune
+        self._executors: Dict[str, Executor] = executors or {}
+        self._offload_decoding_from: Optional[int] = offload_decoding_from
 
-    def handle(self, subscription_request: SubscriptionRequest) -> BotPost:
-        data: JSONType = self.query(subscription_request)
-        return self.represent_response(subscription_request, data)
+    async def handle(self, subscription_request: SubscriptionRequest) -> List[BotPost]:
+        """
+        Raises ServiceUnavailableException while polling an unavailable service.
+        A user asking for posts is answered with a message about it
+        """
+        try:
+            data: JSONType = await self.query(subscription_request)
+        except ServiceUnavailableException as e:
+            if subscription_request.polling:
+                raise
+            warning(e)
+            return [BotPost(text=f'{subscription_request.service} is unavailable for '
+                                 f'{subscription_request.subscription_token} now. Try again later.', photo_urls=[])]
+        return await self._represent_offloaded(subscription_request, data)
 
-    def query(self, subscription_request: SubscriptionRequest) -> JSONType:
+    async def query(self, subscription_request: SubscriptionRequest) -> JSONType:
         """Chooses concrete query preparing strategy by subscription service and query the service"""
+        with QUERY_SECONDS.time(service=subscription_request.service):
+            return await self._query(subscription_request)
+
+    async def _query(self, subscription_request: SubscriptionRequest) -> JSONType:
         strategy: QueryStrategy = self._query_strategy_register.get_strategy_by(subscription_request)
         query: str = strategy.get_query(subscription_request)
-        response = requests.get(query)
-        return response.json()
+        if self._batch_window is not None and isinstance(strategy, BatchQueryStrategy):
+            batcher: QueryBatcher = self._get_batcher(strategy)
+            load = lambda: batcher.query(subscription_request)
+        else:
+            load = lambda: self._fetch(query)
+        if self._resilience is not None:
+            unguarded_load = load
+            subscription_key = (subscription_request.service, subscription_request.subscription_token)
+            load = lambda: self._resilience.call(subscription_request.service, subscription_key, unguarded_load,
+                                                 check=strategy.raise_for_error)
+        if self._prune:
+            load = self._pruned(subscription_request, load)
+        try:
+            if self._cache is None:
+                data, _ = await load()
+                return data
+            return await self._cache.get_or_load(subscription_request.service, query, load)
+        except ServiceUnavailableException as e:
+            stale: Optional[JSONType] = self._cache.get_stale(query) if self._cache is not None else None
+            if stale is None:
+                raise
+            warning(f'Answering with a stale response: {e}')
+            STALE_ANSWERS.inc(service=subscription_request.service)
+            return stale
+
+    def _pruned(self, subscription_request: SubscriptionRequest, load: Loader) -> Loader:
+        """
+        Wraps the load, so the response is pruned before it's cached or represented. Its size becomes the size
+        of the pruned response
+        """
+        represent_strategy: RepresentStrategy = self._represent_strategy_register.get_strategy_by(subscription_request)
+
+        async def load_pruned() -> Tuple[JSONType, int]:
+            data, size = await load()
+            pruned: JSONType = represent_strategy.prune(data)
+            return (data, size) if pruned is data else (pruned, len(json_dumps(pruned)))
+        return load_pruned
+
+    def _get_batcher(self, strategy: BatchQueryStrategy) -> QueryBatcher:
+        if type(strategy) not in self._batchers:
+            self._batchers[type(strategy)] = QueryBatcher(strategy, self._fetch, window=self._batch_window)
+        return self._batchers[type(strategy)]
+
+    async def _fetch(self, query: str) -> Tuple[JSONType, int]:
+        """
+        Requests the query and returns decoded response with its size in bytes.
+        Raises ServiceUnavailableException if the service can't be reached or fails
+        """
+        session = await self._session_pool.get_session()
+        try:
+            async with session.get(query) as response:
+                if response.status >= 500:
+                    raise ServiceUnavailableException(f'Service responded with status {response.status}')
+                body: bytes = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ServiceUnavailableException(f'Service can\'t be reached: {e!r}') from e
+        return await self._decode(body), len(body)
+
+    async def _decode(self, body: bytes) -> JSONType:
+        executor: Optional[Executor] = self._executors.get(THREAD)
+        if executor is None or self._offload_decoding_from is None or len(body) < self._offload_decoding_from:
+            return json_loads(body)
+        OFFLOADED_CALLS.inc(work='decode', cost=THREAD)
+        return await asyncio.get_event_loop().run_in_executor(executor, json_loads, body)
+
+    async def _represent_offloaded(self, subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
+        """Represents in the executor of the strategy's cost hint if there is one"""
+        cost: str = getattr(self._represent_strategy_register.get_strategy_by(subscription_request), 'cost', INLINE)
+        executor: Optional[Executor] = self._executors.get(cost)
+        if executor is None:
+            return self.represent_response(subscription_request, data)
+        OFFLOADED_CALLS.inc(work='represent', cost=cost)
+        with REPRESENT_SECONDS.time(service=subscription_request.service):
+            return await asyncio.get_event_loop().run_in_executor(
+                executor, _represent_by, self._represent_strategy_register, subscription_request, data)
 
-    def represent_response(self, subscription_request: SubscriptionRequest, data: JSONType) -> BotPost:
-        """Represents fetched data as a BotPost. Uses subscription_request to choose a strategy of preparation"""
+    def represent_response(self, subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
+        """Represents fetched data as BotPosts. Uses subscription_request to choose a strategy of preparation"""
         represent_strategy: RepresentStrategy = self._represent_strategy_register.get_strategy_by(subscription_request)
-        return represent_strategy.represent(subscription_request, data)
+        with REPRESENT_SECONDS.time(service=subscription_request.service):
+            return represent_strategy.represent(subscription_request, data)
 
 
 class AllSubscriptionsDummyGrabber:
 
-    def handle(self, subscription_request: SubscriptionRequest) -> BotPost:
-        data: JSONType = self.query(subscription_request)
+    async def handle(self, subscription_request: SubscriptionRequest) -> List[BotPost]:
+        data: JSONType = await self.query(subscription_request)
         return self.represent_response(subscription_request, data)
 
-    def query(self, subscription_request: SubscriptionRequest) -> JSONType:
+    async def query(self, subscription_request: SubscriptionRequest) -> JSONType:
         """Chooses concrete query preparing strategy by subscription service and query the service"""
         return subscription_request.subscription_token
 
-    def represent_response(self, subscription_request: SubscriptionRequest, data: JSONType) -> BotPost:
-        """Represents fetched data as a BotPost. Uses subscription_request to choose a strategy of preparation"""
-        return BotPost(text=data, photo_urls=[])
+    def represent_response(self, subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
+        """Represents fetched data as BotPosts. Uses subscription_request to choose a strategy of preparation"""
+        return [BotPost(text=data, photo_urls=[])]
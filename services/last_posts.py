@@ -0,0 +1,81 @@
+import asyncio
+from logging import warning
+from typing import Dict, Optional, Iterable, Set
+
+from domain.message_handlers import AbstractAsyncUoW, LastPostKey
+
+
+class LastPostTracker:
+    """
+    Keeps ids of the last posts delivered to users in memory in front of the db.
+    Unknown keys are loaded in bulk once, changes are written back in bulk by .flush()
+    which runs periodically after .start()
+    """
+
+    def __init__(self, uow: AbstractAsyncUoW, flush_interval: float = 10.):
+        """
+        uow: AbstractAsyncUoW managing AbstractLastPostRepo
+        flush_interval: float period in seconds between writing changes to the db
+        """
+        self._uow = uow
+        self._flush_interval = flush_interval
+        self._last_post_ids: Dict[LastPostKey, Optional[str]] = {}
+        self._dirty: Set[LastPostKey] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, keys: Iterable[LastPostKey]) -> None:
+        """Fetches not yet known keys from the db with a single query"""
+        unknown: Set[LastPostKey] = {_ for _ in keys if _ not in self._last_post_ids}
+        if not unknown:
+            return
+        async with self._uow:
+            stored: Dict[LastPostKey, Optional[str]] = await self._uow.storage.get_last_post_ids(unknown)
+        for key in unknown:
+            self._last_post_ids.setdefault(key, stored.get(key))
+
+    def is_new(self, key: LastPostKey, post_id: Optional[str]) -> bool:
+        """
+        Posts without id can't be told apart from the delivered ones, so they are never new.
+        Numeric ids grow with time, so a post older than the delivered one isn't new either
+        """
+        if post_id is None:
+            return False
+        last_post_id: Optional[str] = self._last_post_ids.get(key)
+        if last_post_id is not None and post_id.isdigit() and last_post_id.isdigit():
+            return int(post_id) > int(last_post_id)
+        return last_post_id != post_id
+
+    def remember(self, key: LastPostKey, post_id: str) -> None:
+        self._last_post_ids[key] = post_id
+        self._dirty.add(key)
+
+    async def flush(self) -> None:
+        """Writes all the changes made since the previous flush with bulk queries"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            async with self._uow:
+                await self._uow.storage.update_last_post_ids({_: self._last_post_ids[_] for _ in dirty})
+        except Exception:
+            self._dirty |= dirty  # will be retried with the next flush
+            raise
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                warning(f'Failed to store last posts: {e!r}')
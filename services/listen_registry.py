@@ -0,0 +1,187 @@
+import asyncio
+import random
+from dataclasses import astuple
+from datetime import datetime, timedelta, timezone
+from logging import warning, info
+from typing import Iterable, List, Optional, Tuple, Set, Callable, Awaitable, AsyncIterator
+
+from domain.message_handlers import (AbstractAsyncUoW, SubscriptionRequest, ListenSession, BotPost, IDispatcher,
+                                     SendPriority)
+from services.metrics import registry
+from services.pollers import SubscriptionPoller
+from services.sharding import Shard
+
+REHYDRATED_SESSIONS = registry.counter('huddle_rehydrated_listen_sessions_total',
+                                       'Listen sessions restored from the db after a start or a sync')
+
+# (tg_user_id, service, subscription_token) of a listen session subscribed to the poller
+SessionKey = Tuple[int, Optional[str], str]
+
+# Coroutine function which reads a page of (id, session) after the given id from AbstractListenRepo
+PageGetter = Callable[[object, Optional[int]], Awaitable[List[Tuple[int, ListenSession]]]]
+
+# seconds changes are read from before the previous sync, so clock skews of processes and late commits aren't missed
+CHANGES_OVERLAP = 60.
+
+
+class ListenRegistry:
+    """
+    Stores users' listening in the db before subscribing them to the poller, so listeners survive restarts.
+    Stored sessions are rehydrated after .start() in background batches. Each restored subscription is first polled
+    at a random moment within spread seconds and from the last post the user got, so a restart causes neither
+    a burst of service queries nor lost posts.
+    Poller workers of a shard poll only its subscriptions and sync them with the db periodically, since users' commands
+    are stored by the bot's process without a poller. A sync reads only sessions started or stopped since the previous
+    one, all the shard's sessions are reread once in resync_interval to catch deleted ones
+    """
+
+    def __init__(self, uow: AbstractAsyncUoW, poller: Optional[SubscriptionPoller], dispatcher: IDispatcher,
+                 batch_size: int = 100, batch_interval: float = 1., spread: float = 20.,
+                 shard: Optional[Shard] = None, sync_interval: Optional[float] = None, resync_interval: float = 600.):
+        """
+        uow: AbstractAsyncUoW managing AbstractListenRepo
+        poller: SubscriptionPoller if None, listening is only stored to be polled by poller workers
+        batch_size: int sessions read from the db and subscribed at once
+        batch_interval: float seconds between batches of restored sessions
+        spread: float seconds the first polls of restored subscriptions are spread over
+        shard: Shard if given, only its subscriptions are polled
+        sync_interval: float if given, seconds between syncs of the polled sessions with the db
+        resync_interval: float seconds between syncs rereading all the sessions
+        """
+        self._uow = uow
+        self._poller = poller
+        self._dispatcher = dispatcher
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._spread = spread
+        self._shard = shard
+        self._sync_interval = sync_interval
+        self._resync_interval = resync_interval
+        self._shard_range: Optional[Tuple[int, int]] = None if shard is None else astuple(shard)
+        self._subscribed: Set[SessionKey] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def listen(self, chat_id: int, subscription_requests: Iterable[SubscriptionRequest]) -> None:
+        sessions: List[ListenSession] = [ListenSession(_.service, _.subscription_token, _.tg_user_id, chat_id)
+                                         for _ in subscription_requests]
+        async with self._uow:
+            await self._uow.storage.listen(sessions)
+        for session in sessions:
+            if self._owns(session):
+                self._subscribe(session)
+
+    async def stop_listening(self, tg_user_id: int,
+                             subscription_requests: Optional[Iterable[SubscriptionRequest]] = None) -> None:
+        if subscription_requests is None:
+            for key in [_ for _ in self._subscribed if _[0] == tg_user_id]:
+                self._unsubscribe(key)
+            async with self._uow:
+                await self._uow.storage.stop_listening(tg_user_id)
+            return
+        subscription_requests = list(subscription_requests)
+        for _ in subscription_requests:
+            self._unsubscribe((tg_user_id, _.service, _.subscription_token))
+        async with self._uow:
+            await self._uow.storage.stop_listening(tg_user_id, [_.subscription_token for _ in subscription_requests])
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._rehydrate())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _owns(self, session: ListenSession) -> bool:
+        return self._poller is not None and (self._shard is None or self._shard.owns(session.subscription_token))
+
+    def _subscribe(self, session: ListenSession, since_post_id: Optional[str] = None, delay: float = 0.) -> None:
+        async def deliver(post: BotPost):
+            await self._dispatcher.send(session.chat_id, [post], SendPriority.LISTEN)
+
+        request = SubscriptionRequest(session.service, session.subscription_token, session.tg_user_id, since_post_id)
+        self._poller.subscribe(request, session.tg_user_id, deliver, delay=delay)
+        self._subscribed.add((session.tg_user_id, session.service, session.subscription_token))
+
+    def _unsubscribe(self, key: SessionKey) -> None:
+        tg_user_id, service, subscription_token = key
+        self._subscribed.discard(key)
+        if self._poller is not None:
+            self._poller.unsubscribe(SubscriptionRequest(service, subscription_token, tg_user_id), tg_user_id)
+
+    async def _rehydrate(self) -> None:
+        if self._poller is None:
+            return
+        synced_at: datetime = datetime.now(timezone.utc)
+        resynced_at: datetime = synced_at
+        restored: int = await self._sync(self._spread, self._batch_interval)
+        info(f'{restored} listen sessions are restored')
+        while self._sync_interval is not None:
+            await asyncio.sleep(self._sync_interval)
+            started_at: datetime = datetime.now(timezone.utc)
+            if started_at - resynced_at >= timedelta(seconds=self._resync_interval):
+                await self._sync(spread=0., batch_interval=0.)
+                resynced_at = started_at
+            else:
+                await self._sync_changes(synced_at - timedelta(seconds=CHANGES_OVERLAP))
+            synced_at = started_at
+
+    async def _pages(self, get_page: PageGetter, batch_interval: float) -> AsyncIterator[List[ListenSession]]:
+        """Yields stored sessions page by page. A failing page is retried"""
+        after: Optional[int] = None
+        while True:
+            try:
+                async with self._uow:
+                    page: List[Tuple[int, ListenSession]] = await get_page(self._uow.storage, after)
+            except Exception as e:
+                warning(f'Failed to load listen sessions after {after}: {e!r}')
+                await asyncio.sleep(self._batch_interval)
+                continue
+            yield [session for _, session in page if self._owns(session)]
+            if len(page) < self._batch_size:
+                return
+            after = page[-1][0]
+            await asyncio.sleep(batch_interval)
+
+    async def _sync(self, spread: float, batch_interval: float) -> int:
+        """
+        Pages the shard's stored sessions and subscribes unknown ones batch by batch. Sessions subscribed before
+        the sync which aren't stored anymore are unsubscribed. Returns how many are subscribed
+        """
+        subscribed_before: Set[SessionKey] = set(self._subscribed)
+        stored: Set[SessionKey] = set()
+        restored = 0
+        pages = self._pages(lambda storage, after: storage.get_listen_sessions_page(after, self._batch_size,
+                                                                                     self._shard_range),
+                            batch_interval)
+        async for page in pages:
+            for session in page:
+                key: SessionKey = (session.tg_user_id, session.service, session.subscription_token)
+                stored.add(key)
+                if key not in self._subscribed:
+                    self._subscribe(session, since_post_id=session.last_post_id, delay=random.uniform(0, spread))
+                    restored += 1
+        for key in subscribed_before - stored:
+            if key in self._subscribed:
+                self._unsubscribe(key)
+        REHYDRATED_SESSIONS.inc(restored)
+        return restored
+
+    async def _sync_changes(self, since: datetime) -> int:
+        """Subscribes the shard's sessions started since the moment and unsubscribes stopped ones"""
+        restored = 0
+        pages = self._pages(lambda storage, after: storage.get_listen_changes_page(since, after, self._batch_size,
+                                                                                    self._shard_range),
+                            batch_interval=0.)
+        async for page in pages:
+            for session in page:
+                key: SessionKey = (session.tg_user_id, session.service, session.subscription_token)
+                if session.listening and key not in self._subscribed:
+                    self._subscribe(session, since_post_id=session.last_post_id)
+                    restored += 1
+                elif not session.listening and key in self._subscribed:
+                    self._unsubscribe(key)
+        REHYDRATED_SESSIONS.inc(restored)
+        return restored
@@ -0,0 +1,190 @@
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Callable, Optional, Iterator, Sequence, Union
+
+from aiohttp import web
+
+# Values of labels in the order of metric's label names
+LabelValues = Tuple[str, ...]
+
+# Returns the current value of a metric or values by label values
+Collect = Callable[[], Union[float, Dict[LabelValues, float]]]
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class _Metric(ABC):
+    type: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}: {tuple(labels)}')
+        return tuple(str(labels[_]) for _ in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = [*zip(self.labelnames, values), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Returns lines of the metric's values in the text exposition format"""
+        ...
+
+    def render(self) -> str:
+        return '\n'.join((f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}',
+                          *self.samples()))
+
+
+class Counter(_Metric):
+    """Value which only goes up, e.g. requests made"""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1., **labels: str) -> None:
+        key: LabelValues = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0.) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Value which goes up and down, e.g. queue size. Is either set or taken from a function at collecting"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect: Optional[Collect] = None,
+                 metric_type: str = 'gauge'):
+        """
+        collect: Callable returning the value or values by label values when metrics are rendered
+        metric_type: str lets a value counted elsewhere be exposed as a counter
+        """
+        super().__init__(name, documentation, labelnames)
+        self.type = metric_type
+        self._values: Dict[LabelValues, float] = {}
+        self._collect: Optional[Collect] = collect
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._label_values(labels)] = value
+
+    def samples(self) -> List[str]:
+        values: Dict[LabelValues, float] = self._values
+        if self._collect is not None:
+            collected = self._collect()
+            values = collected if isinstance(collected, dict) else {(): collected}
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. durations in seconds, counted into cumulative buckets"""
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {}  # per bucket plus +Inf, not cumulative
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key: LabelValues = self._label_values(labels)
+        counts: List[int] = self._counts.setdefault(key, [0] * (len(self._buckets) + 1))
+        for index, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[key] = self._sums.get(key, 0.) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes seconds spent inside the context. Works around both sync and async code"""
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        samples: List[str] = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip((*self._buckets, float('inf')), counts):
+                cumulative += count
+                le: str = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append(f'{self.name}_bucket{self._format_labels(key, (("le", le),))} {cumulative}')
+            samples.append(f'{self.name}_sum{self._format_labels(key)} {self._sums[key]}')
+            samples.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return samples
+
+
+class MetricsRegistry:
+    """Metrics of the process. Renders them in prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect: Optional[Collect] = None,
+              metric_type: str = 'gauge') -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect, metric_type))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return '\n'.join(_.render() for _ in self._metrics.values()) + '\n'
+
+
+# the registry of the process. Modules register their metrics at import
+registry = MetricsRegistry()
+
+
+class MetricsServer:
+    """Serves the registry at http://host:port/metrics. Use .start()/.stop() along with the bot"""
+
+    def __init__(self, metrics_registry: Optional[MetricsRegistry] = None, host: str = '127.0.0.1', port: int = 9100):
+        self._registry: MetricsRegistry = metrics_registry or registry
+        self._host = host
+        self._port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self._registry.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
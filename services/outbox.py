@@ -0,0 +1,114 @@
+import asyncio
+import os
+import socket
+from logging import warning
+from typing import List, Optional
+
+from domain.message_handlers import AbstractAsyncUoW, BotPost, SendPriority, OutboxEntry, IDispatcher
+from services.metrics import registry
+
+OUTBOX_WRITES = registry.counter('huddle_outbox_writes_total', 'Posts put to the outbox by poller workers')
+OUTBOX_RELAYED = registry.counter('huddle_outbox_relayed_total', 'Outbox posts handed to telegram sending')
+
+
+class OutboxDispatcher:
+    """
+    IDispatcher of poller workers. Puts posts to the shared db outbox instead of sending them, so a single process
+    owns telegram limits. Posts given within flush_window are written with a single query
+    """
+
+    def __init__(self, uow: AbstractAsyncUoW, flush_window: float = 0.05):
+        """uow: AbstractAsyncUoW managing AbstractOutboxRepo"""
+        self._uow = uow
+        self._flush_window = flush_window
+        self._pending: List[OutboxEntry] = []
+        self._flushed: Optional[asyncio.Future] = None  # is done when the pending entries are written
+        self._task: Optional[asyncio.Task] = None
+
+    async def send(self, chat_id: int, posts: List[BotPost], priority: SendPriority) -> None:
+        """Waits until the posts are in the outbox"""
+        if self._flushed is None:
+            self._flushed = asyncio.get_event_loop().create_future()
+            self._task = asyncio.ensure_future(self._flush_later())
+        flushed: asyncio.Future = self._flushed
+        self._pending.extend(OutboxEntry(chat_id, post, priority) for post in posts)
+        await asyncio.shield(flushed)
+
+    async def stop(self) -> None:
+        """Writes the pending posts"""
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._flush_window)
+        entries, flushed = self._pending, self._flushed
+        self._pending, self._flushed = [], None
+        try:
+            async with self._uow:
+                await self._uow.storage.put(entries)
+        except Exception as e:
+            flushed.set_exception(e)
+        else:
+            OUTBOX_WRITES.inc(len(entries))
+            flushed.set_result(None)
+
+
+class OutboxRelay:
+    """
+    Hands posts put to the outbox by poller workers to the dispatcher sending to telegram.
+    A single bot's process runs the relay, so the posts go through a single rate limited dispatcher in the order
+    of the outbox. A page of posts is claimed before sending and deleted after it, posts claimed by a relay which
+    has stopped are claimed again after the lease, so they are sent at least once and a relay started by mistake
+    along with the designated one doesn't send them twice.
+    Use .start()/.stop() along with the bot
+    """
+
+    def __init__(self, uow: AbstractAsyncUoW, dispatcher: IDispatcher, batch_size: int = 100, interval: float = 1.,
+                 lease: float = 300., name: Optional[str] = None):
+        """
+        uow: AbstractAsyncUoW managing AbstractOutboxRepo
+        interval: float seconds between checks of the empty outbox
+        lease: float seconds a claim lasts. Should be longer than sending a page to the slowest chat takes
+        name: str of the relay among others, the host and the process id by default
+        """
+        self._uow = uow
+        self._dispatcher = dispatcher
+        self._batch_size = batch_size
+        self._interval = interval
+        self._lease = lease
+        self._name: str = name or f'{socket.gethostname()}:{os.getpid()}'
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                relayed: int = await self._relay()
+            except Exception as e:
+                warning(f'Failed to relay the outbox: {e!r}')
+                relayed = 0
+            if relayed < self._batch_size:
+                await asyncio.sleep(self._interval)
+
+    async def _relay(self) -> int:
+        """Sends a claimed page of the outbox. Posts failed to be sent are dropped as the dispatcher has retried them"""
+        async with self._uow:
+            entries: List[OutboxEntry] = await self._uow.storage.claim(self._name, self._batch_size, self._lease)
+        if not entries:
+            return 0
+        # the sends are queued in the order of the outbox, so posts to a chat aren't reordered
+        await asyncio.gather(*(self._dispatcher.send(_.chat_id, [_.post], _.priority) for _ in entries),
+                             return_exceptions=True)
+        async with self._uow:
+            await self._uow.storage.delete([_.entry_id for _ in entries])
+        OUTBOX_RELAYED.inc(len(entries))
+        return len(entries)
@@ -0,0 +1,50 @@
+from typing import Optional, Tuple, List
+
+from domain.message_handlers import AbstractAsyncUoW
+
+MESSAGE_LIMIT = 4096  # telegram limit of a message text length
+
+
+class SubscriptionPager:
+    """
+    Packs available subscriptions into pages fitting a single telegram message each.
+    Every page is read from db on its own with keyset pagination, so neither memory nor the query
+    depends on how many subscriptions there are. Cursors are short enough for callback data
+    """
+
+    def __init__(self, uow: AbstractAsyncUoW, page_size: int = 100, text_limit: int = MESSAGE_LIMIT,
+                 title: str = 'Available subscriptions:'):
+        """
+        uow: AbstractAsyncUoW managing AbstractSubscriptionRepo
+        page_size: int the most of subscriptions on a page
+        text_limit: int the most of chars in a page
+        """
+        self._uow = uow
+        self._page_size = page_size
+        self._text_limit = text_limit
+        self._title = title
+
+    async def get_page(self, cursor: Optional[str]) -> Tuple[str, Optional[str]]:
+        """
+        Returns text of the page starting after cursor and the cursor of the next page if there is one.
+        Cursors come back in callback data users may forge, so a malformed one starts from the first page
+        """
+        try:
+            after: Optional[int] = int(cursor) if cursor else None
+        except ValueError:
+            after = None
+        async with self._uow:
+            # one extra row tells if there is a next page
+            rows: List[Tuple[int, str]] = await self._uow.storage.get_subscriptions_page(after, self._page_size + 1)
+        lines: List[str] = [self._title]
+        length: int = len(self._title)
+        last_id: Optional[int] = None
+        for index, (subscription_id, subscription_token) in enumerate(rows):
+            if index == self._page_size or length + 1 + len(subscription_token) > self._text_limit:
+                return '\n'.join(lines), str(last_id)
+            lines.append(subscription_token)
+            length += 1 + len(subscription_token)
+            last_id = subscription_id
+        if last_id is None:
+            return 'There are no subscriptions yet', None
+        return '\n'.join(lines), None
@@ -2,6 +2,9 @@ from logging import warning
 from typing import Iterable
 
 from domain.message_handlers import Alias
+from services.metrics import registry
+
+PARSE_SECONDS = registry.histogram('huddle_parse_seconds', 'Time of parsing user messages into aliases', ['parser'])
 
 
 class SplitParser:
@@ -13,8 +16,9 @@ class SplitParser:
     def parse(self, text: str) -> Iterable[Alias]:
         if not isinstance(text, str):
             raise TypeError(f'Wrong input type: {type(text)}. Should be str')
-        # split with space. trimmed. no empty strings. {'a  a  c   b   ' -> {'a', 'b', 'c'}
-        aliases = set(text.strip('/').split())
+        # split with space. trimmed. no empty strings. keeps user's order. 'a  a  c   b   ' -> ['a', 'c', 'b']
+        with PARSE_SECONDS.time(parser='split'):
+            aliases = list(dict.fromkeys(text.strip('/').split()))
         return aliases
 
 
@@ -35,6 +39,7 @@ class ListenParser:
         if not text.startswith(self._command):
             raise ValueError(f'Text must starts with "{self._command}"')
 
-        # split with space. trimmed. no empty strings. '/listen a  a  c   b   ' -> {'a', 'b', 'c'}
-        aliases = set(text[len(self._command):].split())
+        # split with space. trimmed. no empty strings. keeps user's order. '/listen a  a  c   b   ' -> ['a', 'c', 'b']
+        with PARSE_SECONDS.time(parser='listen'):
+            aliases = list(dict.fromkeys(text[len(self._command):].split()))
         return aliases
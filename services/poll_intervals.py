@@ -0,0 +1,88 @@
+import random
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Hashable
+
+from domain.message_handlers import BotPost
+
+
+@dataclass
+class _PollState:
+    interval: float  # seconds between polls before jitter
+    last_published_at: Optional[float] = None  # publishing time of the latest seen post
+    mean_gap: Optional[float] = None  # smoothed seconds between posts
+
+
+class AdaptivePollInterval:
+    """
+    Learns how often each subscription posts and chooses its poll interval within bounds.
+    A poll without new posts makes the interval longer, new posts make it shorter and not longer than
+    a fraction of the mean gap between posts. Delays are jittered, so subscriptions don't get polled in bursts
+    """
+
+    def __init__(self,
+                 initial: float = 20.,
+                 min_interval: float = 10.,
+                 max_interval: float = 600.,
+                 backoff: float = 1.5,
+                 rate_fraction: float = 0.25,
+                 smoothing: float = 0.3,
+                 jitter: float = 0.1):
+        """
+        initial: float interval in seconds of a subscription which hasn't been polled yet
+        min_interval: float, max_interval: float bounds of the interval in seconds
+        backoff: float the interval is multiplied by it after a poll without new posts and divided after new posts
+        rate_fraction: float after new posts the interval is at most this fraction of the mean gap between posts
+        smoothing: float weight of a new gap between posts in the mean gap
+        jitter: float relative random deviation of the returned delays
+        """
+        self._initial = initial
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._rate_fraction = rate_fraction
+        self._smoothing = smoothing
+        self._jitter = jitter
+        self._states: Dict[Hashable, _PollState] = {}
+
+    def interval_of(self, key: Hashable) -> float:
+        state: Optional[_PollState] = self._states.get(key)
+        return self._initial if state is None else state.interval
+
+    def next_delay(self, key: Hashable, posts: Optional[List[BotPost]]) -> float:
+        """
+        Returns seconds to wait before the next poll of the subscription given posts of the current one.
+        None posts mean the poll failed, so the interval stays the same. So do posts which are only placeholders,
+        e.g. about no result, since they have neither id nor publishing time
+        """
+        state: _PollState = self._states.setdefault(key, _PollState(self._clamp(self._initial)))
+        if posts is not None:
+            known: List[BotPost] = [_ for _ in posts if _.post_id is not None or _.published_at is not None]
+            if known or not posts:
+                self._observe(state, known)
+        return state.interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def forget(self, key: Hashable) -> None:
+        self._states.pop(key, None)
+
+    def _observe(self, state: _PollState, posts: List[BotPost]) -> None:
+        published: List[float] = sorted(_.published_at for _ in posts if _.published_at is not None)
+        if state.last_published_at is None and published:  # the first seen post tells nothing about the rate yet
+            state.last_published_at = published[-1]
+            return
+        new: List[float] = [_ for _ in published if _ > state.last_published_at] \
+            if state.last_published_at is not None else []
+        if not new and all(_.published_at is not None for _ in posts):
+            state.interval = self._clamp(state.interval * self._backoff)
+            return
+        for published_at in new:
+            gap: float = published_at - state.last_published_at
+            state.mean_gap = gap if state.mean_gap is None \
+                else self._smoothing * gap + (1 - self._smoothing) * state.mean_gap
+            state.last_published_at = published_at
+        interval: float = state.interval / self._backoff
+        if state.mean_gap is not None:
+            interval = min(interval, state.mean_gap * self._rate_fraction)
+        state.interval = self._clamp(interval)
+
+    def _clamp(self, interval: float) -> float:
+        return min(self._max_interval, max(self._min_interval, interval))
@@ -0,0 +1,169 @@
+import asyncio
+from dataclasses import replace
+from logging import warning
+from typing import Dict, Tuple, Optional, Callable, Awaitable, List, Set
+
+from domain.message_handlers import SubscriptionRequest, BotPost, IGrabber, LastPostKey
+from services.last_posts import LastPostTracker
+from services.poll_intervals import AdaptivePollInterval
+
+# (service, subscription_token) is polled once no matter how many users listen to it
+SubscriptionKey = Tuple[Optional[str], str]
+
+# Coroutine function which delivers a BotPost to a listener
+ListenerCallback = Callable[[BotPost], Awaitable[None]]
+
+
+class SubscriptionPoller:
+    """
+    Polls every distinct (service, subscription_token) once per interval and fans the result out
+    to all its listeners. Works on its own tasks, so it doesn't depend on handlers which subscribed listeners.
+    Use .subscribe()/.unsubscribe() at runtime and .start()/.stop() along with the bot
+    """
+
+    def __init__(self, grabber: IGrabber, interval: float = 20., max_concurrency: int = 16,
+                 tracker: Optional[LastPostTracker] = None,
+                 intervals: Optional[AdaptivePollInterval] = None):
+        """
+        interval: float period in seconds between polls of the same subscription
+        max_concurrency: int the most of subscriptions being polled at once
+        tracker: LastPostTracker if given, listeners get only posts they haven't got yet. Listener ids are
+        telegram user ids then
+        intervals: AdaptivePollInterval if given, chooses the period of each subscription by its posting rate
+        instead of the fixed interval
+        """
+        self._grabber = grabber
+        self._tracker = tracker
+        self._interval = interval
+        self._intervals = intervals
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._listeners: Dict[SubscriptionKey, Dict[int, ListenerCallback]] = {}
+        self._requests: Dict[SubscriptionKey, SubscriptionRequest] = {}  # a request used for polling a key
+        self._due: Dict[SubscriptionKey, float] = {}  # loop time of the next poll of a key
+        self._last_posts: Dict[SubscriptionKey, BotPost] = {}  # the latest grabbed post of a key
+        self._cursors: Dict[SubscriptionKey, str] = {}  # id of the latest grabbed post, next polls fetch newer ones
+        self._in_flight: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def key_of(subscription_request: SubscriptionRequest) -> SubscriptionKey:
+        return subscription_request.service, subscription_request.subscription_token
+
+    def subscribe(self, subscription_request: SubscriptionRequest, listener_id: int,
+                  callback: ListenerCallback, delay: float = 0.) -> None:
+        """
+        Adds a listener to the subscription. A new subscription is polled in delay seconds,
+        a known one delivers its latest post to the new listener.
+        since_post_id of the request of a new subscription makes the first poll grab posts newer than it
+        instead of the latest one
+        """
+        key: SubscriptionKey = self.key_of(subscription_request)
+        listeners: Dict[int, ListenerCallback] = self._listeners.setdefault(key, {})
+        listeners[listener_id] = callback
+        if key not in self._requests:
+            self._requests[key] = subscription_request
+            if subscription_request.since_post_id is not None:
+                self._cursors[key] = subscription_request.since_post_id
+            self._due[key] = asyncio.get_event_loop().time() + delay
+            self._wakeup.set()
+        elif key in self._last_posts:
+            self._spawn(self._deliver(key, {listener_id: callback}, self._last_posts[key]))
+
+    def unsubscribe(self, subscription_request: SubscriptionRequest, listener_id: int) -> None:
+        """Removes the listener from the subscription. The subscription isn't polled without listeners"""
+        key: SubscriptionKey = self.key_of(subscription_request)
+        listeners: Dict[int, ListenerCallback] = self._listeners.get(key, {})
+        listeners.pop(listener_id, None)
+        if not listeners:
+            self._forget(key)
+
+    def unsubscribe_all(self, listener_id: int) -> None:
+        """Removes the listener from every subscription"""
+        for key in list(self._listeners):
+            self.unsubscribe(self._requests[key], listener_id)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        tasks: List[asyncio.Task] = [*self._in_flight, *([self._task] if self._task else [])]
+        [task.cancel() for task in tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def _forget(self, key: SubscriptionKey) -> None:
+        self._listeners.pop(key, None)
+        self._requests.pop(key, None)
+        self._due.pop(key, None)
+        self._last_posts.pop(key, None)
+        self._cursors.pop(key, None)
+        if self._intervals is not None:
+            self._intervals.forget(key)
+
+    def _spawn(self, coro: Awaitable) -> None:
+        task: asyncio.Task = asyncio.ensure_future(coro)
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _run(self) -> None:
+        """Starts polls of due subscriptions and sleeps until the nearest due time or a new subscription"""
+        loop = asyncio.get_event_loop()
+        while True:
+            now: float = loop.time()
+            due: List[SubscriptionKey] = [key for key, due_time in self._due.items() if due_time <= now]
+            for key in due:
+                self._due[key] = float('inf')  # isn't rescheduled until the current poll is done
+                self._spawn(self._poll(key))
+            self._wakeup.clear()
+            scheduled: List[float] = [due_time for due_time in self._due.values() if due_time != float('inf')]
+            delay: float = min(scheduled, default=now + self._interval) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, key: SubscriptionKey) -> None:
+        """
+        Grabs the subscription once and delivers posts to all its current listeners from the oldest one.
+        The first poll grabs the latest post, the next ones grab only posts newer than the latest grabbed
+        """
+        posts: Optional[List[BotPost]] = None
+        try:
+            async with self._semaphore:
+                if key not in self._requests:  # unsubscribed while waiting
+                    return
+                request: SubscriptionRequest = replace(self._requests[key], since_post_id=self._cursors.get(key),
+                                                       polling=True)
+                posts = await self._grabber.handle(request)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warning(f'Failed to poll {key}: {e!r}')
+        else:
+            if key in self._listeners and posts:
+                self._last_posts[key] = posts[-1]
+                if posts[-1].post_id is not None:
+                    self._cursors[key] = posts[-1].post_id
+                for post in posts:
+                    await self._deliver(key, dict(self._listeners[key]), post)
+        finally:
+            if key in self._due:
+                delay: float = self._interval if self._intervals is None else self._intervals.next_delay(key, posts)
+                self._due[key] = asyncio.get_event_loop().time() + delay
+                self._wakeup.set()
+
+    async def _deliver(self, key: SubscriptionKey, listeners: Dict[int, ListenerCallback], post: BotPost) -> None:
+        """Sends the post to every listener which hasn't got it yet. A failing listener doesn't affect others"""
+        if self._tracker is not None:
+            last_post_keys: Dict[int, LastPostKey] = {_: (_, key[1]) for _ in listeners}
+            await self._tracker.load(last_post_keys.values())
+            listeners = {listener_id: callback for listener_id, callback in listeners.items()
+                         if self._tracker.is_new(last_post_keys[listener_id], post.post_id)}
+        results = await asyncio.gather(*(callback(post) for callback in listeners.values()), return_exceptions=True)
+        for listener_id, result in zip(listeners, results):
+            if isinstance(result, Exception):
+                warning(f'Failed to deliver {key} to listener {listener_id}: {result!r}')
+            elif self._tracker is not None:
+                self._tracker.remember(last_post_keys[listener_id], post.post_id)
@@ -1,8 +1,19 @@
-from typing import Protocol
+import json
+from typing import Protocol, List, Dict, Any, runtime_checkable
+from urllib.parse import quote
 
-from domain.message_handlers import SubscriptionRequest
+from domain.message_handlers import SubscriptionRequest, JSONType
+from services.exceptions import VKBadRequestException, VKTransientException
 from tokens import VK_API_TOKEN, VK_USER_ID
 
+VK_API_VERSION = '5.84'
+# posts requested at once when only the ones newer than a known post are needed
+VK_INCREMENTAL_COUNT = 10
+# posts requested for the latest one, since a pinned post goes first
+VK_LATEST_COUNT = 2
+# vk api error codes worth retrying: unknown, too many requests per second, flood control, internal, rate limit
+VK_TRANSIENT_ERROR_CODES = frozenset({1, 6, 9, 10, 29})
+
 
 class QueryStrategy(Protocol):
     """Abstract protocol to handle concrete strategies of services' querying"""
@@ -10,13 +21,84 @@ class QueryStrategy(Protocol):
     def get_query(self, subscription_request: SubscriptionRequest) -> str:
         ...
 
+    def raise_for_error(self, data: JSONType) -> None:
+        """Raises an exception telling how the error inside the service's response should be treated"""
+        ...
+
+
+@runtime_checkable
+class BatchQueryStrategy(Protocol):
+    """Strategy which is also able to query several subscriptions of the service with a single request"""
+    max_batch_size: int
+
+    def get_query(self, subscription_request: SubscriptionRequest) -> str:
+        ...
+
+    def get_batch_query(self, subscription_requests: List[SubscriptionRequest]) -> str:
+        ...
+
+    def split_batch_response(self, data: JSONType, subscription_requests: List[SubscriptionRequest]) -> List[JSONType]:
+        """Splits response of the batch query into responses as if each request was queried on its own"""
+        ...
+
 
 class VKQueryStrategy:
-    """Strategy to query vk.com api"""
+    """Strategy to query vk.com api. Several groups are queried at once with a single `execute` method"""
+    max_batch_size: int = 25  # vk limit of api calls inside a single execute
+    api_url: str = 'https://api.vk.com/method'  # is replaced with a local stand-in by benchmarks
 
     @staticmethod
-    def get_query(subscription_request: SubscriptionRequest) -> str:
+    def _get_wall_params(subscription_request: SubscriptionRequest) -> Dict[str, Any]:
+        """
+        wall.get can't filter by post id, so a window of the latest posts is requested when posts newer
+        than since_post_id are needed. The window doesn't depend on since_post_id, so its queries are shared
+        """
         domain_id: str = subscription_request.subscription_token  # should be group name
-        vk_query = f"https://api.vk.com/method/wall.get?access_token={VK_API_TOKEN}&user_id={VK_USER_ID}&" \
-                   f"domain={domain_id}&count={1}&v=5.84"
+        count: int = VK_LATEST_COUNT if subscription_request.since_post_id is None else VK_INCREMENTAL_COUNT
+        return {'domain': domain_id, 'count': count}
+
+    @classmethod
+    def get_query(cls, subscription_request: SubscriptionRequest) -> str:
+        params: Dict[str, Any] = cls._get_wall_params(subscription_request)
+        vk_query = f"{cls.api_url}/wall.get?access_token={VK_API_TOKEN}&user_id={VK_USER_ID}&" \
+                   f"domain={params['domain']}&count={params['count']}&v={VK_API_VERSION}"
         return vk_query
+
+    @staticmethod
+    def raise_for_error(data: JSONType) -> None:
+        """Raises VKTransientException if the request is worth repeating, VKBadRequestException for other errors"""
+        if not isinstance(data, dict) or 'error' not in data:
+            return
+        error: Dict[str, Any] = data['error']
+        msg: str = f"Error while requesting vk api: {error.get('error_msg')}"
+        if error.get('error_code') in VK_TRANSIENT_ERROR_CODES:
+            raise VKTransientException(msg)
+        raise VKBadRequestException(msg)
+
+    @classmethod
+    def get_batch_query(cls, subscription_requests: List[SubscriptionRequest]) -> str:
+        if not 0 < len(subscription_requests) <= cls.max_batch_size:
+            raise ValueError(f'From 1 to {cls.max_batch_size} requests can be batched: {len(subscription_requests)}')
+        calls: str = ','.join(f'API.wall.get({json.dumps(cls._get_wall_params(_))})' for _ in subscription_requests)
+        vk_query = f"{cls.api_url}/execute?access_token={VK_API_TOKEN}&" \
+                   f"code={quote(f'return [{calls}];')}&v={VK_API_VERSION}"
+        return vk_query
+
+    @staticmethod
+    def split_batch_response(data: JSONType, subscription_requests: List[SubscriptionRequest]) -> List[JSONType]:
+        """
+        Execute returns a list of results where a failed call is `false`. Its error is the next
+        one of `execute_errors`. An error of the whole execute becomes the error of each request
+        """
+        if 'error' in data:
+            return [data for _ in subscription_requests]
+        results: List[JSONType] = data['response']
+        errors = iter(data.get('execute_errors', []))
+        split: List[JSONType] = []
+        for result in results:
+            if result is False:
+                error: Dict[str, Any] = next(errors, {'error_msg': 'Unknown error inside execute'})
+                split.append({'error': error})
+            else:
+                split.append({'response': result})
+        return split
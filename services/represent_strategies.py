@@ -1,131 +1,143 @@
+import itertools
 from logging import warning
-from typing import Protocol, List, Dict
+from typing import Protocol, List, Dict, Any, Optional, Union
 
 from domain.message_handlers import JSONType, BotPost, SubscriptionRequest
-from services.exceptions import VKNonRegularPostResponse, VKBadRequestException, NotAppropriateContent
+from services.exceptions import (BaseVKException, VKNonRegularPostResponse, VKBadRequestException,
+                                 NotAppropriateContent)
+from services.caches import RenderedPostCache
+from services.extraction import ExtractionSpec, CompiledSpec
+
+# namespaces of strategies in the rendered post cache. Unlike id() they aren't reused by a strategy of another spec
+_strategy_namespaces = itertools.count()
 
 
 class RepresentStrategy(Protocol):
     """Abstract protocol to handle concrete strategies for representation of services' api answers"""
+    cost: str  # INLINE, THREAD or PROCESS hint of services.extraction
 
-    def represent(self, subscription_request: SubscriptionRequest, data: JSONType) -> BotPost:
+    def represent(self, subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
         ...
 
+    def prune(self, data: JSONType) -> JSONType:
+        """Returns a copy of the api answer keeping only the values represent reads"""
+        ...
 
-class MilongaRepresentStrategy:
-    """In case of listening daily milongas vk.com group"""
 
-    @classmethod
-    def represent(cls, subscription_request: SubscriptionRequest, data: JSONType) -> BotPost:
+class VKWallRepresentStrategy:
+    """
+    Represents posts of a vk.com wall as the extraction spec declares. Without since_post_id in the request
+    the latest post is represented, otherwise each post newer than since_post_id from the oldest one.
+    A user is told when there is no result, listeners of polling requests get only represented posts.
+    With post_cache a post is represented once while its values the spec reads are the same
+    """
+
+    def __init__(self, spec: ExtractionSpec, post_cache: Optional[RenderedPostCache] = None):
+        self._spec = CompiledSpec(spec)
+        self.cost: str = spec.cost
+        self._post_cache = post_cache
+        self._namespace: int = next(_strategy_namespaces)
+
+    def prune(self, data: JSONType) -> JSONType:
+        """Keeps only the values the spec needs of each post. Errors and unexpected answers are kept as they are"""
+        if not isinstance(data, dict) or 'response' not in data or not isinstance(data['response'], dict) \
+                or not isinstance(data['response'].get('items'), list):
+            return data
+        return {'response': {'items': [self._spec.prune(_) for _ in data['response']['items']]}}
+
+    def represent(self, subscription_request: SubscriptionRequest, data: JSONType) -> List[BotPost]:
+        no_result = BotPost(text=self._spec.spec.no_result_text, photo_urls=[])
         try:
-            group_resp: BotPost = cls._presentate_milongas_or_err(data)
+            items: List[Dict] = self._select_items(subscription_request, data)
         except (VKBadRequestException, VKNonRegularPostResponse) as e:
             warning(e)
-            group_resp = BotPost(text='No result for milongas. See terminal log.', photo_urls=[])
-        return group_resp
-
-    @classmethod
-    def _presentate_milongas_or_err(cls, data: JSONType) -> BotPost:
-        """Extract polling answers from post attachment, sorts with milonga rate and returns formatted string.
-        If error occurred while responding or can't find milongas inside valid response raises corresponding exception
-        """
+            # a failed poll is repeated with the next one, so there is nothing to tell listeners
+            return [no_result] if self._is_asked(subscription_request) else []
+        if self._is_asked(subscription_request):
+            try:
+                return [self._represent(item) for item in items]
+            except BaseVKException as e:
+                warning(e)
+                return [no_result]
+        posts: List[BotPost] = []
+        for item in items:  # a single unsuitable post doesn't prevent others from being represented
+            try:
+                posts.append(self._represent(item))
+            except BaseVKException as e:
+                warning(e)
+        return posts
+
+    @staticmethod
+    def _is_asked(subscription_request: SubscriptionRequest) -> bool:
+        """Tells whether a user asked for the latest post, so the user should be told about no result"""
+        return subscription_request.since_post_id is None and not subscription_request.polling
+
+    @staticmethod
+    def _select_items(subscription_request: SubscriptionRequest, data: JSONType) -> List[Dict]:
+        """Returns posts to be represented. Raises corresponding exception if error occurred while responding"""
         if 'error' in data:
             msg = data['error']['error_msg']
             raise VKBadRequestException(f'Error while requesting vk api: {msg}')
         try:
-            # finds date of milonga by # char
-            date_ends_index: int = data['response']['items'][0]['text'].index('#')
-            date: str = data['response']['items'][0]['text'][:date_ends_index]
-            # finds and sorts milongas from polling
-            milongas: JSONType = data['response']['items'][0]['attachments'][0]['poll']['answers']  # list of milongas
-            milongas.sort(key=lambda _: _['votes'], reverse=True)
-            ret = date
-            for milonga in milongas:
-                assert isinstance(milonga, Dict)
-                rate = milonga['rate']
-                name = milonga['text']
-                votes = milonga['votes']
-                ret = ''.join((ret, f'\n{name}\n{rate}% - {votes} чел.'))
-            return BotPost(text=ret, photo_urls=[])
-        except (KeyError, IndexError) as e:
-            raise VKNonRegularPostResponse(f'Something went wrong while parsing milongas. '
-                                           f'Expected structure: [\'response\'][\'items\'][0][\'attachments\'][0]'
-                                           f'[\'poll\'][\'answers\'][0...][\'rate\'] | [\' votes\'] | [\'text\']') from e
-
-
-class OldclothersRepresentStrategy:
-    @classmethod
-    def represent(cls, subscription_request: SubscriptionRequest, data: Dict) -> BotPost:
+            items: List[Dict] = data['response']['items']
+            if subscription_request.since_post_id is None:
+                # a pinned post goes first whatever its age, so the latest post is the newest of the others
+                unpinned: List[Dict] = [_ for _ in items if not _.get('is_pinned')]
+                return [max(unpinned, key=lambda _: _['id'])] if unpinned else []
+            since: int = int(subscription_request.since_post_id)
+            return sorted((_ for _ in items if _['id'] > since), key=lambda _: _['id'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise VKNonRegularPostResponse(f'Something went wrong while parsing posts. '
+                                           f'Expected structure: [\'response\'][\'items\'][0...][\'id\']') from e
+
+    def _represent(self, item: Dict) -> BotPost:
+        """Represents a single post. Raises BaseVKException if it can't"""
+        if self._post_cache is None:
+            return self._represent_item(item)
+        # posts which can't be represented are cached as well, so the exception is raised again
+        represented: Union[BotPost, BaseVKException] = self._post_cache.get_or_represent(
+            self._namespace, self._spec.prune(item), lambda: self._represent_or_exception(item))
+        if isinstance(represented, BaseVKException):
+            raise represented.with_traceback(None)
+        return represented
+
+    def _represent_or_exception(self, item: Dict) -> Union[BotPost, BaseVKException]:
         try:
-            group_resp: BotPost = cls._represent_old_or_err(data)
-        except (VKBadRequestException, VKNonRegularPostResponse) as e:
-            warning(e)
-            group_resp = BotPost('No result for oldclothers. See terminal log.', photo_urls=[])
-        return group_resp
+            return self._represent_item(item)
+        except BaseVKException as e:
+            return e
 
-    @classmethod
-    def _represent_old_or_err(cls, data: JSONType) -> BotPost:
-        """Extracts text from the last post of oldclothers group
-        """
-        if 'error' in data:
-            msg = data['error']['error_msg']
-            raise VKBadRequestException(f'Error while requesting vk api: {msg}')
-        try:
-            post_photos_urls: List[str] = cls._fetch_photos(data)
-            post_text: str = cls._fetch_text(data)
-            return BotPost(post_text, post_photos_urls)
-        except (KeyError, IndexError) as e:
-            raise VKNonRegularPostResponse(f'Something went wrong while parsing post. '
-                                           f'Expected structure: [\'response\'][\'items\'][0][\'text\']') from e
-
-    @classmethod
-    def _fetch_photos(cls, data: JSONType) -> List[str]:
-        """Returns a list of url of attached photos"""
-        photo_urls = []
-        if 'copy_history' not in data['response']['items'][0]:  # if not a repost
-            photos_number = len(data['response']['items'][0]['attachments'])
-            [photo_urls.append(data['response']['items'][0]
-                               ['attachments'][idx]['photo']['sizes'][-1]['url']) for idx in range(photos_number)]
-        else:  # if repost - other structure
-            photos_number = len(data['response']['items'][0]['copy_history'][0]['attachments'])
-            [photo_urls.append(data['response']['items'][0]['copy_history'][0]
-                               ['attachments'][idx]['photo']['sizes'][-1]['url']) for idx in range(photos_number)]
-        return photo_urls
-
-    @classmethod
-    def _fetch_text(cls, data: JSONType) -> str:
-        if 'copy_history' not in data['response']['items'][0]:  # is not repost
-            post_text = data['response']['items'][0]['text'] or '_Post text is unavailable_'
-        else:  # is a repost
-            post_text = data['response']['items'][0]['copy_history'][0]['text'] or '_Post text is unavailable_'
-        return post_text
-
-
-class KvartalRepresentStrategy:
-
-    @classmethod
-    def represent(cls, subscription_request: SubscriptionRequest, data: Dict) -> BotPost:
-        try:
-            group_resp: BotPost = cls._presentate_Kvartal_or_err(data)
-        except (VKBadRequestException, VKNonRegularPostResponse) as e:
-            warning(e)
-            group_resp = BotPost('No result for KvartalTango. See terminal log.', photo_urls=[])
-        return group_resp
-        pass
-
-    @classmethod
-    def _presentate_Kvartal_or_err(cls, data: JSONType) -> BotPost:
-        if 'error' in data:
-            msg = data['error']['error_msg']
-            raise VKBadRequestException(f'Error while requesting vk api: {msg}')
+    def _represent_item(self, item: Dict) -> BotPost:
         try:
-            # finds date of milonga by # char
-            text: str = data['response']['items'][0]['text'] or '_No text available'
-            # FIXME: this logic has to be separated to special filtering or fetching strategy while grabbing data
-            if all(['Время: ' in text, 'Розенштейна' in text, 'Стоимость' in text]):
-                return BotPost(text=text, photo_urls=[])
-            else:
-                raise NotAppropriateContent(f'The post doesn\'t contain info about kvartal\'s milonga')
-        except (KeyError, IndexError) as e:
-            raise VKNonRegularPostResponse(f'Something went wrong while parsing post. '
-                                         f'Expected structure: [\'response\'][\'items\'][0] [\'text\']') from e
\ No newline at end of file
+            text: str = self._spec.text(item)
+            photo_urls: List[str] = self._spec.photo_urls(item)
+            post_id: str = str(item['id'])
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise VKNonRegularPostResponse(f'Something went wrong while parsing post: {e!r}. '
+                                           f'Expected structure: {self._spec.spec}') from e
+        if not self._spec.is_appropriate(text):
+            raise NotAppropriateContent(f'The post {post_id} doesn\'t contain {self._spec.spec.required_phrases}')
+        return BotPost(text, photo_urls, post_id=post_id, published_at=item.get('date'))
+
+
+def render_milongas(text: str, fields: Dict[str, Any]) -> str:
+    """Takes the date of milongas from the text before # and lists polled milongas sorted by their rate"""
+    date: str = text[:text.index('#')]
+    # responses may be shared through the cache, so they are never changed in place
+    milongas: List[Dict] = sorted(fields['answers'], key=lambda _: _['votes'], reverse=True)
+    return ''.join((date, *(f'\n{_["text"]}\n{_["rate"]}% - {_["votes"]} чел.' for _ in milongas)))
+
+
+# daily milongas vk.com group. The post is a poll about where to dance
+MILONGA_SPEC = ExtractionSpec(fields={'answers': 'attachments[0].poll.answers'},
+                              render=render_milongas,
+                              no_result_text='No result for milongas. See terminal log.')
+
+OLDCLOTHERS_SPEC = ExtractionSpec(photo_urls='attachments[*].photo.sizes[-1].url',
+                                  repost='copy_history[0]',
+                                  no_result_text='No result for oldclothers. See terminal log.')
+
+# FIXME: this logic has to be separated to special filtering or fetching strategy while grabbing data
+KVARTAL_SPEC = ExtractionSpec(no_text='_No text available',
+                              required_phrases=('Время: ', 'Розенштейна', 'Стоимость'),
+                              no_result_text='No result for KvartalTango. See terminal log.')
@@ -0,0 +1,156 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from logging import warning
+from typing import Dict, Hashable, Optional, Tuple, Type, Callable, Awaitable
+
+from domain.message_handlers import JSONType
+from services.exceptions import (ServiceUnavailableException, CircuitOpenException, VKTransientException,
+                                 VKBadRequestException)
+from services.metrics import registry
+
+# Coroutine function which loads a response and returns it along with its size in bytes
+Loader = Callable[[], Awaitable[Tuple[JSONType, int]]]
+
+# Raises an exception if the loaded response contains an error
+ErrorCheck = Callable[[JSONType], None]
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+UPSTREAM_ERRORS = registry.counter('huddle_upstream_errors_total', 'Failed service calls by exception',
+                                   ['service', 'error'])
+UPSTREAM_RETRIES = registry.counter('huddle_upstream_retries_total', 'Repeated service calls', ['service'])
+CIRCUIT_REJECTIONS = registry.counter('huddle_circuit_rejections_total', 'Calls refused by an open circuit',
+                                      ['service'])
+
+
+@dataclass
+class _CircuitState:
+    failures: int = 0  # consecutive failures
+    opened_at: Optional[float] = None  # time.monotonic() the circuit was opened
+    probing: bool = False  # a single call is let through to check whether the upstream is back
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures per key. After failure_threshold of them the key's circuit opens and calls
+    are refused for reset_timeout seconds. Then a single probe call is let through: its success closes the circuit,
+    its failure opens it again
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._states: Dict[Hashable, _CircuitState] = {}
+
+    def state_of(self, key: Hashable) -> str:
+        state: Optional[_CircuitState] = self._states.get(key)
+        if state is None or state.opened_at is None:
+            return CLOSED
+        if state.probing or time.monotonic() >= state.opened_at + self._reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self, key: Hashable) -> bool:
+        """Tells whether a call may be made. Being let through as a probe is remembered"""
+        state: Optional[_CircuitState] = self._states.get(key)
+        if state is None or state.opened_at is None:
+            return True
+        if state.probing or time.monotonic() < state.opened_at + self._reset_timeout:
+            return False
+        state.probing = True
+        return True
+
+    def record_success(self, key: Hashable) -> None:
+        self._states.pop(key, None)
+
+    def record_failure(self, key: Hashable) -> None:
+        state: _CircuitState = self._states.setdefault(key, _CircuitState())
+        state.failures += 1
+        if state.probing or state.failures >= self._failure_threshold:
+            if state.opened_at is None or state.probing:
+                warning(f'Circuit of {key} is open for {self._reset_timeout}s after {state.failures} failures')
+            state.opened_at = time.monotonic()
+            state.probing = False
+
+    def release(self, key: Hashable) -> None:
+        """Gives up a probe which ended with neither success nor failure, e.g. was cancelled"""
+        state: Optional[_CircuitState] = self._states.get(key)
+        if state is not None:
+            state.probing = False
+
+
+class ResilientCaller:
+    """
+    Makes service calls with bounded exponential backoff retries behind circuit breakers.
+    Exception classes define the policy:
+    retry_on - the service fails as a whole. The call is retried and counts against the service's circuit;
+    give_up_on - the subscription is wrong. The response is returned as is and counts against the subscription's circuit
+    """
+
+    def __init__(self,
+                 breaker: Optional[CircuitBreaker] = None,
+                 attempts: int = 3,
+                 base_delay: float = 0.5,
+                 max_delay: float = 5.,
+                 retry_on: Tuple[Type[Exception], ...] = (ServiceUnavailableException, VKTransientException),
+                 give_up_on: Tuple[Type[Exception], ...] = (VKBadRequestException,)):
+        """
+        attempts: int calls made at most for a single load
+        base_delay: float, max_delay: float seconds before the first retry and the most before any retry
+        """
+        self._breaker: CircuitBreaker = breaker or CircuitBreaker()
+        self._attempts = attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._retry_on = retry_on
+        self._give_up_on = give_up_on
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self._breaker
+
+    async def call(self, service: Optional[str], subscription_key: Hashable, load: Loader,
+                   check: Optional[ErrorCheck] = None) -> Tuple[JSONType, int]:
+        """
+        Loads the response retrying on failures of the service.
+        Raises CircuitOpenException without calling if the service or the subscription has been failing,
+        ServiceUnavailableException if the service keeps failing after all the attempts
+        """
+        for attempt in range(self._attempts):
+            if not self._breaker.allow(service):
+                CIRCUIT_REJECTIONS.inc(service=service)
+                raise CircuitOpenException(f'{service} is failing, not queried for now')
+            if not self._breaker.allow(subscription_key):
+                self._breaker.release(service)
+                CIRCUIT_REJECTIONS.inc(service=service)
+                raise CircuitOpenException(f'{subscription_key} is failing, not queried for now')
+            failure: Optional[Exception] = None
+            try:
+                data, size = await load()
+                if check is not None:
+                    check(data)
+            except self._retry_on as e:
+                failure = e
+            except self._give_up_on as e:
+                UPSTREAM_ERRORS.inc(service=service, error=type(e).__name__)
+                self._breaker.record_success(service)
+                self._breaker.record_failure(subscription_key)
+                return data, size
+            except BaseException:
+                self._breaker.release(service)
+                self._breaker.release(subscription_key)
+                raise
+            if failure is None:
+                self._breaker.record_success(service)
+                self._breaker.record_success(subscription_key)
+                return data, size
+            UPSTREAM_ERRORS.inc(service=service, error=type(failure).__name__)
+            self._breaker.release(subscription_key)
+            self._breaker.record_failure(service)
+            if attempt == self._attempts - 1:
+                raise ServiceUnavailableException(f'{service} failed {self._attempts} times: {failure}') from failure
+            delay: float = min(self._max_delay, self._base_delay * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(.5, 1.))
+            UPSTREAM_RETRIES.inc(service=service)
@@ -0,0 +1,41 @@
+from typing import Optional
+
+import aiohttp
+
+
+class HTTPSessionPool:
+    """
+    Keeps a single pooled keep-alive aiohttp session for the whole process.
+    Session is created lazily inside the running event loop. Use .close() on shutdown
+    """
+
+    def __init__(self,
+                 limit: int = 100,
+                 limit_per_host: int = 10,
+                 keepalive_timeout: float = 30.,
+                 total_timeout: float = 10.,
+                 connect_timeout: float = 3.):
+        self._limit = limit  # total simultaneous connections
+        self._limit_per_host = limit_per_host  # simultaneous connections to the same endpoint
+        self._keepalive_timeout = keepalive_timeout
+        self._timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Returns the shared session creating it at first call"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit,
+                                             limit_per_host=self._limit_per_host,
+                                             keepalive_timeout=self._keepalive_timeout,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# the pool shared by all grabbers unless other is given
+default_session_pool = HTTPSessionPool()
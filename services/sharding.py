@@ -0,0 +1,33 @@
+import zlib
+from dataclasses import dataclass
+
+
+def shard_key(subscription_token: str) -> int:
+    """crc32 of the token. Is stored along with listen sessions, so a shard of them is selected by the db"""
+    return zlib.crc32(subscription_token.encode())
+
+
+@dataclass(frozen=True)
+class Shard:
+    """
+    Part of subscriptions owned by one of count poller workers. Subscriptions are split by crc32 of their tokens
+    since it's the same in every process unlike the salted builtin hash
+    """
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if not 0 <= self.index < self.count:
+            raise ValueError(f'Wrong shard {self.index} of {self.count}')
+
+    @classmethod
+    def parse(cls, value: str) -> 'Shard':
+        """Parses 'index/count', e.g. '0/4' is the first of four shards"""
+        try:
+            index, count = (int(_) for _ in value.split('/'))
+        except ValueError:
+            raise ValueError(f'Shard should be given as index/count: {value}') from None
+        return cls(index, count)
+
+    def owns(self, subscription_token: str) -> bool:
+        return shard_key(subscription_token) % self.count == self.index
@@ -1,11 +1,14 @@
-from typing import Dict, Tuple, Optional
+from typing import Dict, Tuple, Optional, Set
 
 from domain.message_handlers import SubscriptionRequest
 from services.query_strategies import VKQueryStrategy, QueryStrategy
+from services.caches import RenderedPostCache
+from services.extraction import ExtractionSpec, INLINE
 from services.represent_strategies import (RepresentStrategy,
-                                           MilongaRepresentStrategy,
-                                           OldclothersRepresentStrategy,
-                                           KvartalRepresentStrategy)
+                                           VKWallRepresentStrategy,
+                                           MILONGA_SPEC,
+                                           OLDCLOTHERS_SPEC,
+                                           KVARTAL_SPEC)
 
 
 class QueryStrategyRegister:
@@ -32,12 +35,36 @@ class RepresentStrategyRegister:
     """
     The register of various strategies to be used for represent services' answers.
     Uses service's domain and subscription token as a key for
+    Strategies of vk.com walls are built from extraction specs, so a new group is added with .register()
     Use .get_strategy_by(subscription_request) to get concrete strategy
         """
-    _storage: Dict[Tuple[str, str], RepresentStrategy] = {('vk.com', 'milonga'): MilongaRepresentStrategy,
-                                                          ('vk.com', 'oldclothers'): OldclothersRepresentStrategy,
-                                                          ('vk.com', 'kvartal_tango'): KvartalRepresentStrategy,
-                                                          }
+    _specs: Dict[Tuple[str, str], ExtractionSpec] = {('vk.com', 'milonga'): MILONGA_SPEC,
+                                                     ('vk.com', 'oldclothers'): OLDCLOTHERS_SPEC,
+                                                     ('vk.com', 'kvartal_tango'): KVARTAL_SPEC,
+                                                     }
+    _storage: Dict[Tuple[str, str], RepresentStrategy] = {}  # strategies built from specs
+    _post_cache: Optional[RenderedPostCache] = None
+
+    @classmethod
+    def use_post_cache(cls, post_cache: Optional[RenderedPostCache]) -> None:
+        """
+        Makes strategies of specs hinting heavy representing share the given cache of represented posts.
+        A cache hit costs hashing of the post, which is more than representing of INLINE specs. None stops caching
+        """
+        cls._post_cache = post_cache
+        cls._storage.clear()
+
+    @classmethod
+    def cost_hints(cls) -> Set[str]:
+        """Cost hints of the registered specs, so executors are made only for hinted costs"""
+        return {_.cost for _ in cls._specs.values()}
+
+    @classmethod
+    def register(cls, domain: str, subscription: str, spec: ExtractionSpec) -> None:
+        if domain != 'vk.com':
+            raise ValueError(f'Extraction specs are supported for vk.com only: {domain}')
+        cls._specs[(domain, subscription)] = spec
+        cls._storage.pop((domain, subscription), None)
 
     @classmethod
     def get_strategy_by(cls, subscription_request: SubscriptionRequest) -> RepresentStrategy:
@@ -46,4 +73,10 @@ class RepresentStrategyRegister:
         strategy: Optional[RepresentStrategy] = cls._storage.get((domain, subscription))
         if strategy:
             return strategy
+        spec: Optional[ExtractionSpec] = cls._specs.get((domain, subscription))
+        if spec:
+            # paths of the spec are compiled once, the strategy is reused for all the responses
+            post_cache: Optional[RenderedPostCache] = cls._post_cache if spec.cost != INLINE else None
+            strategy = cls._storage[(domain, subscription)] = VKWallRepresentStrategy(spec, post_cache)
+            return strategy
         raise ValueError(f'Wrong SubscriptionRequest. The strategy for: {domain, subscription} is not supported.')
@@ -1,11 +1,31 @@
-from typing import Optional
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Optional, Any, Callable, Awaitable
 
 import domain
 
 DEFAULT_DJANGO_SETTINGS = "web_app.web_app.settings"
 
 
+@lru_cache(maxsize=None)
+def setup_django(settings: str = DEFAULT_DJANGO_SETTINGS) -> None:
+    """Bootstraps django orm. Does the work only once per process, so call it at process start"""
+    import django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings)
+    django.setup()
+
+
+# django connections are bound to threads, so the orm is used from the event loop only through this thread
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+
 class DjangoUoW(domain.AbstractUoW):
+    """
+    Manages a django backed repository. Django is set up and the repository is built only
+    at the first entering, so entering the context afterwards costs nothing but the queries made inside
+    """
     import django
 
     def __init__(self,
@@ -15,22 +35,74 @@ class DjangoUoW(domain.AbstractUoW):
         self._django_settings: str = settings
         self.storage_cls: type[domain.AbstractAliasRepo] = repository
         self.__storage: Optional[domain.AbstractAliasRepo] = None
+        self.__depth: int = 0  # how many times the context has been entered and not exited yet
 
     @property
     def storage(self) -> domain.AbstractAliasRepo:
-        if self.__storage is None:
+        if self.__storage is None or not self.__depth:
             raise AssertionError(f'Repository should be managed only with context manager')
         return self.__storage
 
     def __enter__(self) -> domain.AbstractUoW:
-        import os
-        os.environ.setdefault("DJANGO_SETTINGS_MODULE", self._django_settings)
-        os.environ.setdefault("DJANGO_ALLOW_ASYNC_UNSAFE", "True")
-        self.django.setup()
-        from web_app.huddle_service_bot import models
-        model = getattr(models, self.storage_cls.model_name)
-        self.__storage = self.storage_cls(model)
+        if self.__storage is None:
+            setup_django(self._django_settings)
+            from web_app.huddle_service_bot import models
+            model = getattr(models, self.storage_cls.model_name)
+            self.__storage = self.storage_cls(model)
+        self.__depth += 1
         return super().__enter__()
 
     def __exit__(self, *args):
-        self.django.db.close_old_connections()
+        self.__depth -= 1
+        if not self.__depth:
+            self.django.db.close_old_connections()
+
+
+class _ThreadedRepository:
+    """Exposes methods of a repository as coroutine functions which run in the given executor"""
+
+    def __init__(self, repository: domain.AbstractRepo, run: Callable[..., Awaitable[Any]]):
+        self._repository = repository
+        self._run = run
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._repository, name)
+        if not callable(attribute):
+            return attribute
+
+        async def method(*args, **kwargs) -> Any:
+            return await self._run(attribute, *args, **kwargs)
+
+        return method
+
+
+class AsyncDjangoUoW(domain.AbstractAsyncUoW):
+    """
+    DjangoUoW to be used inside the event loop. Entering, exiting and every repository call run in
+    the db executor, so queries never block the loop:
+        async with uow:
+            resolution = await uow.storage.get_subscriptions_info_by(aliases)
+    """
+
+    def __init__(self,
+                 repository: type(domain.AbstractRepo),
+                 settings: str = DEFAULT_DJANGO_SETTINGS,
+                 executor: Optional[ThreadPoolExecutor] = None,
+                 ):
+        self._uow = DjangoUoW(repository, settings)
+        self._executor: ThreadPoolExecutor = executor or db_executor
+
+    @property
+    def storage(self) -> _ThreadedRepository:
+        return _ThreadedRepository(self._uow.storage, self.run)
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Runs a sync callable using the orm in the db executor"""
+        return await asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def __aenter__(self) -> domain.AbstractAsyncUoW:
+        await self.run(self._uow.__enter__)
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await self.run(self._uow.__exit__, *args)
@@ -0,0 +1,77 @@
+import asyncio
+from collections import OrderedDict
+from logging import warning
+from typing import Optional
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from domain.message_handlers import AbstractAsyncUoW
+from services.metrics import registry
+
+DUPLICATE_UPDATES = registry.counter('huddle_duplicate_updates_total', 'Redelivered telegram updates which are skipped')
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    """
+    Skips telegram updates which have been taken by this or any other worker of the bot, so a webhook update
+    redelivered to another worker behind the load balancer isn't answered twice.
+    Recent update ids are kept in memory, the rest are checked with the shared db.
+    Use .start()/.stop() along with the bot to forget old updates periodically
+    """
+
+    def __init__(self, uow: AbstractAsyncUoW,
+                 recent: int = 10_000,
+                 retention: float = 24 * 60 * 60.,
+                 cleanup_interval: float = 60 * 60.):
+        """
+        uow: AbstractAsyncUoW managing AbstractProcessedUpdateRepo
+        recent: int the most of update ids kept in memory
+        retention: float seconds to remember updates in the db. Telegram stops redelivering an update in a day
+        """
+        super().__init__()
+        self._uow = uow
+        self._recent_limit = recent
+        self._retention = retention
+        self._cleanup_interval = cleanup_interval
+        self._recent: OrderedDict[int, None] = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    async def on_pre_process_update(self, update: types.Update, data: dict) -> None:
+        if not await self.is_first(update.update_id):
+            DUPLICATE_UPDATES.inc()
+            raise CancelHandler()
+
+    async def is_first(self, update_id: int) -> bool:
+        """Marks the update as taken. If the shared db fails, the update is processed rather than lost"""
+        if update_id in self._recent:
+            return False
+        self._recent[update_id] = None
+        if len(self._recent) > self._recent_limit:
+            self._recent.popitem(last=False)
+        try:
+            async with self._uow:
+                return await self._uow.storage.mark_processed(update_id)
+        except Exception as e:
+            warning(f'Failed to mark update {update_id} as processed: {e!r}')
+            return True
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with self._uow:
+                    await self._uow.storage.forget_processed_before(self._retention)
+            except Exception as e:
+                warning(f'Failed to forget processed updates: {e!r}')
+            await asyncio.sleep(self._cleanup_interval)
@@ -0,0 +1,35 @@
+import asyncio
+import unittest
+from unittest.mock import Mock, patch
+
+from domain.message_handlers import BotPost, SendPriority
+from services.dispatchers import OutboundDispatcher, TokenBucket
+
+
+class ChatBucketsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dispatcher = OutboundDispatcher(Mock(), chat_rate=1000, chat_burst=3)
+
+    async def test_keeps_buckets_of_chats_with_queued_posts(self):
+        self.dispatcher.submit(1, [BotPost('post', [])], SendPriority.LISTEN)
+        bucket: TokenBucket = self.dispatcher._chat_bucket(1)
+        await asyncio.sleep(0.01)  # the bucket is full
+        with patch('services.dispatchers.CHAT_BUCKETS_LIMIT', 1):
+            self.dispatcher._chat_bucket(2)
+            self.dispatcher._chat_bucket(3)
+        self.assertIs(self.dispatcher._chat_bucket(1), bucket)
+        self.assertNotIn(2, self.dispatcher._chat_buckets)
+
+    async def test_keeps_blocked_buckets(self):
+        bucket: TokenBucket = self.dispatcher._chat_bucket(1)
+        bucket.block(30)
+        await asyncio.sleep(0.01)  # tokens are refilled while the chat is blocked
+        with patch('services.dispatchers.CHAT_BUCKETS_LIMIT', 1):
+            self.dispatcher._chat_bucket(2)
+            self.dispatcher._chat_bucket(3)
+        self.assertIs(self.dispatcher._chat_bucket(1), bucket)
+        self.assertGreater(bucket.try_acquire(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from services.extraction import compile_path, compile_pruner
+
+
+class CompilePathTest(unittest.TestCase):
+    data = {'items': [{'id': 1, 'photo': {'sizes': [{'url': 'a_s'}, {'url': 'a'}]}},
+                      {'id': 2},
+                      {'id': 3, 'photo': {'sizes': [{'url': 'b'}]}}]}
+
+    def test_keys_and_indexes(self):
+        self.assertEqual(compile_path('items[0].id')(self.data), 1)
+        self.assertEqual(compile_path('items[-1].photo.sizes[0].url')(self.data), 'b')
+        self.assertEqual(compile_path('items')(self.data), self.data['items'])
+
+    def test_each_skips_elements_without_the_rest(self):
+        self.assertEqual(compile_path('items[*].photo.sizes[-1].url')(self.data), ['a', 'b'])
+        self.assertEqual(compile_path('items[*].id')(self.data), [1, 2, 3])
+
+    def test_missing_values_raise(self):
+        for path, error in (('items[5].id', IndexError), ('items[0].text', KeyError), ('items[0].id.x', TypeError)):
+            with self.subTest(path=path), self.assertRaises(error):
+                compile_path(path)(self.data)
+
+    def test_wrong_paths(self):
+        for path in ('', '.a', 'a.', 'a..b', 'a[x]', 'a[0', 'a.[0]'):
+            with self.subTest(path=path), self.assertRaises(ValueError):
+                compile_path(path)
+
+
+class CompilePrunerTest(unittest.TestCase):
+    item = {'id': 1, 'date': 5, 'text': 't', 'likes': {'count': 3},
+            'attachments': [{'type': 'photo', 'photo': {'sizes': [{'url': 'a', 'width': 1}], 'owner_id': 2}},
+                            {'type': 'link', 'link': {'url': 'l'}}]}
+
+    def test_keeps_only_needed_values(self):
+        prune = compile_pruner(['id', 'text', 'attachments[*].photo.sizes[-1].url'])
+        self.assertEqual(prune(self.item), {'id': 1, 'text': 't',
+                                            'attachments': [{'photo': {'sizes': [{'url': 'a'}]}}, {}]})
+
+    def test_pruned_value_is_read_by_the_same_paths(self):
+        paths = ['attachments[0].photo.sizes[-1].url', 'attachments[*].photo.owner_id', 'date']
+        pruned = compile_pruner(paths)(self.item)
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(compile_path(path)(pruned), compile_path(path)(self.item))
+
+    def test_whole_value_wins_over_its_parts(self):
+        prune = compile_pruner(['likes', 'likes.count'])
+        self.assertEqual(prune(self.item), {'likes': {'count': 3}})
+        prune = compile_pruner(['likes.count', 'likes'])
+        self.assertEqual(prune(self.item), {'likes': {'count': 3}})
+
+    def test_unexpected_shapes_are_kept(self):
+        prune = compile_pruner(['attachments[*].photo'])
+        self.assertEqual(prune({'attachments': 'none'}), {'attachments': 'none'})
+        self.assertEqual(prune({'other': 1}), {})
+
+    def test_doesnt_change_the_value(self):
+        item = {'id': 1, 'text': 't'}
+        pruned = compile_pruner(['id'])(item)
+        self.assertEqual(item, {'id': 1, 'text': 't'})
+        self.assertIsNot(pruned, item)
+
+
+if __name__ == '__main__':
+    unittest.main()
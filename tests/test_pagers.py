@@ -0,0 +1,41 @@
+import unittest
+from typing import List, Optional, Tuple
+
+from services.pagers import SubscriptionPager
+
+
+class Storage:
+    def __init__(self, tokens: List[str]):
+        self.rows: List[Tuple[int, str]] = list(enumerate(tokens, start=1))
+
+    async def get_subscriptions_page(self, after: Optional[int], limit: int) -> List[Tuple[int, str]]:
+        return [_ for _ in self.rows if after is None or _[0] > after][:limit]
+
+
+class UoW:
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class SubscriptionPagerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.pager = SubscriptionPager(UoW(Storage(['a', 'b', 'c'])), page_size=2, title='Title')
+
+    async def test_pages(self):
+        self.assertEqual(await self.pager.get_page(None), ('Title\na\nb', '2'))
+        self.assertEqual(await self.pager.get_page('2'), ('Title\nc', None))
+
+    async def test_malformed_cursor_starts_from_the_first_page(self):
+        for cursor in ('x', '1.5', '²'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(await self.pager.get_page(cursor), ('Title\na\nb', '2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
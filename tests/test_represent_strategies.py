@@ -0,0 +1,101 @@
+import unittest
+from typing import List, Optional, Tuple
+
+from domain.message_handlers import SubscriptionRequest
+from services.represent_strategies import VKWallRepresentStrategy, MILONGA_SPEC, OLDCLOTHERS_SPEC, KVARTAL_SPEC
+
+
+def photo(url: str) -> dict:
+    return {'type': 'photo', 'photo': {'sizes': [{'url': url + '_small'}, {'url': url}]}}
+
+
+# posts of each group with (text, photo urls, post id) the strategy classes preceding extraction specs made of them
+# when a user asked for the latest post and when the post was polled as a new one
+SAMPLES = {
+    'milonga': [
+        ({'id': 3, 'date': 1, 'text': '12.10 #milonga', 'attachments': [{'poll': {'answers': [
+            {'text': 'A', 'rate': 20, 'votes': 2}, {'text': 'B', 'rate': 80, 'votes': 8}]}}]},
+         [('12.10 \nB\n80% - 8 чел.\nA\n20% - 2 чел.', [], '3')],
+         [('12.10 \nB\n80% - 8 чел.\nA\n20% - 2 чел.', [], '3')]),
+        ({'id': 4, 'date': 2, 'text': 'no hash', 'attachments': []},
+         [('No result for milongas. See terminal log.', [], None)],
+         []),
+    ],
+    'oldclothers': [
+        ({'id': 5, 'date': 1, 'text': 't', 'attachments': [photo('a'), photo('b')]},
+         [('t', ['a', 'b'], '5')],
+         [('t', ['a', 'b'], '5')]),
+        ({'id': 6, 'date': 2, 'text': '', 'copy_history': [{'text': 'orig', 'attachments': [photo('c')]}]},
+         [('orig', ['c'], '6')],
+         [('orig', ['c'], '6')]),
+        ({'id': 7, 'date': 3, 'text': '', 'attachments': []},
+         [('_Post text is unavailable_', [], '7')],
+         [('_Post text is unavailable_', [], '7')]),
+    ],
+    'kvartal_tango': [
+        ({'id': 8, 'text': 'Время: 1 Розенштейна Стоимость'},
+         [('Время: 1 Розенштейна Стоимость', [], '8')],
+         [('Время: 1 Розенштейна Стоимость', [], '8')]),
+        ({'id': 9, 'text': 'other'},
+         [('No result for KvartalTango. See terminal log.', [], None)],
+         []),
+    ],
+}
+
+SPECS = {'milonga': MILONGA_SPEC, 'oldclothers': OLDCLOTHERS_SPEC, 'kvartal_tango': KVARTAL_SPEC}
+
+
+class VKWallRepresentStrategyTest(unittest.TestCase):
+    def represent(self, token: str, request: SubscriptionRequest, data) -> List[Tuple[str, List[str], Optional[str]]]:
+        strategy = VKWallRepresentStrategy(SPECS[token])
+        return [(_.text, _.photo_urls, _.post_id) for _ in strategy.represent(request, data)]
+
+    def test_matches_previous_strategies(self):
+        for token, samples in SAMPLES.items():
+            for item, asked, polled in samples:
+                data = {'response': {'items': [item]}}
+                with self.subTest(token=token, post=item['id']):
+                    self.assertEqual(self.represent(token, SubscriptionRequest('vk.com', token, 1), data), asked)
+                    self.assertEqual(self.represent(token, SubscriptionRequest('vk.com', token, 1, '0'), data), polled)
+
+    def test_pruned_response_is_represented_the_same(self):
+        for token, samples in SAMPLES.items():
+            strategy = VKWallRepresentStrategy(SPECS[token])
+            items = [dict(item, likes={'count': 1}, views={'count': 2}) for item, _, polled in samples if polled]
+            data = {'response': {'count': len(items), 'items': items}}
+            request = SubscriptionRequest('vk.com', token, 1, '0')
+            with self.subTest(token=token):
+                self.assertEqual(strategy.represent(request, strategy.prune(data)), strategy.represent(request, data))
+
+    def test_new_posts_from_the_oldest(self):
+        items = [{'id': _, 'date': _, 'text': f'post {_}', 'attachments': []} for _ in (12, 11, 10, 9)]
+        request = SubscriptionRequest('vk.com', 'oldclothers', 1, '10', polling=True)
+        posts = VKWallRepresentStrategy(OLDCLOTHERS_SPEC).represent(request, {'response': {'items': items}})
+        self.assertEqual([_.post_id for _ in posts], ['11', '12'])
+        self.assertEqual([_.published_at for _ in posts], [11, 12])
+
+    def test_errors_tell_only_users_asking(self):
+        strategy = VKWallRepresentStrategy(OLDCLOTHERS_SPEC)
+        error = {'error': {'error_code': 15, 'error_msg': 'Access denied'}}
+        with self.assertLogs(level='WARNING'):
+            asked = strategy.represent(SubscriptionRequest('vk.com', 'oldclothers', 1), error)
+            polled = strategy.represent(SubscriptionRequest('vk.com', 'oldclothers', 1, polling=True), error)
+        self.assertEqual([_.text for _ in asked], [OLDCLOTHERS_SPEC.no_result_text])
+        self.assertEqual(polled, [])
+
+    def test_pinned_post_is_skipped(self):
+        strategy = VKWallRepresentStrategy(OLDCLOTHERS_SPEC)
+        items = [{'id': 2, 'date': 2, 'is_pinned': 1, 'text': 'pinned', 'attachments': []},
+                 {'id': 15, 'date': 15, 'text': 'latest', 'attachments': []},
+                 {'id': 14, 'date': 14, 'text': 'older', 'attachments': []}]
+        data = strategy.prune({'response': {'items': items}})
+        for request in (SubscriptionRequest('vk.com', 'oldclothers', 1),
+                        SubscriptionRequest('vk.com', 'oldclothers', 1, polling=True)):
+            with self.subTest(polling=request.polling):
+                self.assertEqual([_.post_id for _ in strategy.represent(request, data)], ['15'])
+        request = SubscriptionRequest('vk.com', 'oldclothers', 1, '14', polling=True)
+        self.assertEqual([_.post_id for _ in strategy.represent(request, data)], ['15'])
+
+
+if __name__ == '__main__':
+    unittest.main()
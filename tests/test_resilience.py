@@ -0,0 +1,146 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from services.exceptions import (ServiceUnavailableException, CircuitOpenException, VKBadRequestException,
+                                 VKTransientException)
+from services.resilience import CircuitBreaker, ResilientCaller, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = patch('services.resilience.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    def open(self, key: str = 'vk.com') -> None:
+        for _ in range(2):
+            self.breaker.record_failure(key)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure('vk.com')
+        self.assertEqual(self.breaker.state_of('vk.com'), CLOSED)
+        self.assertTrue(self.breaker.allow('vk.com'))
+        self.breaker.record_failure('vk.com')
+        self.assertEqual(self.breaker.state_of('vk.com'), OPEN)
+        self.assertFalse(self.breaker.allow('vk.com'))
+        self.assertTrue(self.breaker.allow('other'))
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure('vk.com')
+        self.breaker.record_success('vk.com')
+        self.breaker.record_failure('vk.com')
+        self.assertEqual(self.breaker.state_of('vk.com'), CLOSED)
+
+    def test_half_open_lets_single_probe(self):
+        self.open()
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state_of('vk.com'), HALF_OPEN)
+        self.assertTrue(self.breaker.allow('vk.com'))
+        self.assertFalse(self.breaker.allow('vk.com'))
+
+    def test_probe_success_closes(self):
+        self.open()
+        self.clock.now += 30
+        self.breaker.allow('vk.com')
+        self.breaker.record_success('vk.com')
+        self.assertEqual(self.breaker.state_of('vk.com'), CLOSED)
+
+    def test_probe_failure_opens_again(self):
+        self.open()
+        self.clock.now += 30
+        self.breaker.allow('vk.com')
+        self.breaker.record_failure('vk.com')
+        self.assertEqual(self.breaker.state_of('vk.com'), OPEN)
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow('vk.com'))
+
+    def test_release_gives_up_probe(self):
+        self.open()
+        self.clock.now += 30
+        self.breaker.allow('vk.com')
+        self.breaker.release('vk.com')
+        self.assertTrue(self.breaker.allow('vk.com'))
+
+
+class ResilientCallerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        self.caller = ResilientCaller(self.breaker, attempts=3, base_delay=0)
+        self.calls = 0
+
+    def loader(self, *outcomes):
+        """Returns a load which raises or returns the outcomes one by one"""
+        async def load():
+            outcome = outcomes[self.calls]
+            self.calls += 1
+            if isinstance(outcome, BaseException):
+                raise outcome
+            return outcome, 1
+        return load
+
+    async def test_retries_failures_of_service(self):
+        caller = ResilientCaller(CircuitBreaker(failure_threshold=5), attempts=3, base_delay=0)
+        load = self.loader(ServiceUnavailableException('down'), VKTransientException('busy'), {'response': 1})
+        self.assertEqual(await caller.call('vk.com', 'group', load), ({'response': 1}, 1))
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(caller.breaker.state_of('vk.com'), CLOSED)
+
+    async def test_raises_after_attempts_and_opens_circuit(self):
+        load = self.loader(*[ServiceUnavailableException('down')] * 3)
+        with self.assertRaises(ServiceUnavailableException):
+            await self.caller.call('vk.com', 'group', load)
+        self.assertEqual(self.calls, 2)  # the circuit opens after the second failure
+        with self.assertRaises(CircuitOpenException):
+            await self.caller.call('vk.com', 'group', self.loader({'response': 1}))
+
+    async def test_gives_up_on_subscription_errors(self):
+        def check(data):
+            if 'error' in data:
+                raise VKBadRequestException('private')
+
+        error = {'error': {'error_code': 15}}
+        for _ in range(2):
+            self.calls = 0
+            self.assertEqual(await self.caller.call('vk.com', 'group', self.loader(error), check), (error, 1))
+            self.assertEqual(self.calls, 1)
+        self.assertEqual(self.breaker.state_of('vk.com'), CLOSED)
+        self.assertEqual(self.breaker.state_of('group'), OPEN)
+        with self.assertRaises(CircuitOpenException):
+            await self.caller.call('vk.com', 'group', self.loader(error), check)
+        self.assertTrue(self.breaker.allow('vk.com'))  # the service isn't held by the refused subscription
+
+    async def test_cancelled_probe_is_released(self):
+        clock = Clock()
+        with patch('services.resilience.time.monotonic', clock):
+            self.breaker.record_failure('vk.com')
+            self.breaker.record_failure('vk.com')
+            clock.now += 30
+            started = asyncio.Event()
+
+            async def hanging():
+                started.set()
+                await asyncio.sleep(10)
+
+            task = asyncio.ensure_future(self.caller.call('vk.com', 'group', hanging))
+            await started.wait()
+            self.assertFalse(self.breaker.allow('vk.com'))  # the probe is in flight
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(self.breaker.state_of('vk.com'), HALF_OPEN)
+            self.assertTrue(self.breaker.allow('vk.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Service',
+            fields=[
+                ('id', models.IntegerField(auto_created=True, primary_key=True, serialize=False)),
+                ('service_token', models.CharField(max_length=255, unique=True, verbose_name='Service')),
+            ],
+            options={
+                'verbose_name': 'Service',
+                'verbose_name_plural': 'Services',
+                'ordering': ['service_token'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.IntegerField(auto_created=True, primary_key=True, serialize=False)),
+                ('subscription_token', models.CharField(max_length=255, unique=True, verbose_name='Subscription')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscriptions', to='huddle_service_bot.service')),
+            ],
+            options={
+                'verbose_name': 'Subscription',
+                'verbose_name_plural': 'Subscriptions',
+                'ordering': ['subscription_token'],
+            },
+        ),
+        migrations.CreateModel(
+            name='LastPostForUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_post_id', models.CharField(blank=True, max_length=256, null=True)),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='huddle_service_bot.subscription')),
+            ],
+            options={
+                'verbose_name': 'Last post',
+                'verbose_name_plural': 'Last posts',
+                'ordering': ['telegram_user'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SubscriptionAlias',
+            fields=[
+                ('id', models.IntegerField(auto_created=True, primary_key=True, serialize=False)),
+                ('alias', models.CharField(max_length=16, verbose_name='Alias')),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='huddle_service_bot.subscription')),
+            ],
+            options={
+                'verbose_name': 'Alias',
+                'verbose_name_plural': 'Aliases',
+                'ordering': ['subscription'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TelegramUser',
+            fields=[
+                ('id', models.IntegerField(auto_created=True, primary_key=True, serialize=False)),
+                ('telegram_id', models.IntegerField(unique=True, verbose_name='TelegramUser')),
+                ('name', models.CharField(blank=True, max_length=256, null=True, verbose_name='Name')),
+                ('subscriptions', models.ManyToManyField(related_name='telegram_users', through='huddle_service_bot.LastPostForUser', to='huddle_service_bot.subscription')),
+            ],
+            options={
+                'verbose_name': 'TelegramUser',
+                'verbose_name_plural': 'TelegramUsers',
+                'ordering': ['telegram_id'],
+            },
+        ),
+        migrations.AddField(
+            model_name='lastpostforuser',
+            name='telegram_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='huddle_service_bot.telegramuser'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+def fill_alias_normalized(apps, schema_editor):
+    """Fills the normalized aliases in. Aliases which differ only by case have to be fixed by hand beforehand"""
+    SubscriptionAlias = apps.get_model('huddle_service_bot', 'SubscriptionAlias')
+    aliases = list(SubscriptionAlias.objects.all())
+    seen = {}
+    for alias in aliases:
+        alias.alias_normalized = alias.alias.casefold()
+        if alias.alias_normalized in seen:
+            raise ValueError(f'Aliases {seen[alias.alias_normalized]!r} and {alias.alias!r} differ only by case. '
+                             f'Rename or delete one of them before migrating')
+        seen[alias.alias_normalized] = alias.alias
+    SubscriptionAlias.objects.bulk_update(aliases, ['alias_normalized'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('huddle_service_bot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionalias',
+            name='alias_normalized',
+            field=models.CharField(editable=False, max_length=64, null=True, verbose_name='Normalized alias'),
+        ),
+        migrations.RunPython(fill_alias_normalized, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='subscriptionalias',
+            name='alias_normalized',
+            field=models.CharField(editable=False, max_length=64, unique=True, verbose_name='Normalized alias'),
+        ),
+        migrations.AddConstraint(
+            model_name='lastpostforuser',
+            constraint=models.UniqueConstraint(fields=('telegram_user', 'subscription'),
+                                               name='unique_last_post_for_user'),
+        ),
+        migrations.AddIndex(
+            model_name='lastpostforuser',
+            index=models.Index(fields=['subscription', 'telegram_user'], name='last_post_subscription_user'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('huddle_service_bot', '0002_alias_normalized_and_last_post_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedUpdate',
+            fields=[
+                ('update_id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='Update id')),
+                ('processed_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Processed at')),
+            ],
+            options={
+                'verbose_name': 'Processed update',
+                'verbose_name_plural': 'Processed updates',
+            },
+        ),
+    ]
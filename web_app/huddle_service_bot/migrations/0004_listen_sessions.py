@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('huddle_service_bot', '0003_processed_update'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lastpostforuser',
+            name='chat_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='lastpostforuser',
+            name='listening',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='lastpostforuser',
+            index=models.Index(fields=['listening', 'id'], name='last_post_listening'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('huddle_service_bot', '0004_listen_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxPost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(verbose_name='Chat id')),
+                ('priority', models.SmallIntegerField(default=1, verbose_name='Priority')),
+                ('text', models.TextField(verbose_name='Text')),
+                ('photo_urls', models.JSONField(blank=True, default=list, verbose_name='Photo urls')),
+                ('post_id', models.CharField(blank=True, max_length=256, null=True, verbose_name='Post id')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+            ],
+            options={
+                'verbose_name': 'Outbox post',
+                'verbose_name_plural': 'Outbox posts',
+            },
+        ),
+    ]
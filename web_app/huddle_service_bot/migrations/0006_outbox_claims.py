@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('huddle_service_bot', '0005_outbox_post'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxpost',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Claimed at'),
+        ),
+        migrations.AddField(
+            model_name='outboxpost',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Claimed by'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:08
+
+import zlib
+
+from django.db import migrations, models
+
+
+def fill_shard_keys(apps, schema_editor):
+    """Fills crc32 of subscription tokens in as services.sharding.shard_key does"""
+    LastPostForUser = apps.get_model('huddle_service_bot', 'LastPostForUser')
+    last_posts = list(LastPostForUser.objects.select_related('subscription'))
+    for last_post in last_posts:
+        last_post.shard_key = zlib.crc32(last_post.subscription.subscription_token.encode())
+    LastPostForUser.objects.bulk_update(last_posts, ['shard_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('huddle_service_bot', '0006_outbox_claims'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lastpostforuser',
+            name='listen_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='lastpostforuser',
+            name='shard_key',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_shard_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='lastpostforuser',
+            index=models.Index(fields=['listen_changed_at'], name='last_post_listen_changed'),
+        ),
+    ]
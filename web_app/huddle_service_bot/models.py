@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 
 class Service(models.Model):
@@ -45,21 +46,78 @@ class TelegramUser(models.Model):
 class SubscriptionAlias(models.Model):
     id = models.IntegerField(primary_key=True, auto_created=True)
     alias = models.CharField(max_length=16, verbose_name='Alias')
+    # filled in on save. bulk operations skip save() so they have to fill it in with .normalize()
+    alias_normalized = models.CharField(max_length=64, unique=True, editable=False, verbose_name='Normalized alias')
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE, related_name='aliases')
 
     def __str__(self):
         return f'{self.alias}'
 
+    @staticmethod
+    def normalize(alias: str) -> str:
+        """Case-insensitive form of alias to be stored and looked up with"""
+        return alias.casefold()
+
+    def validate_unique(self, exclude=None):
+        """Checks the normalized alias too, since it isn't editable and forms skip its unique check"""
+        super().validate_unique(exclude)
+        if exclude and 'alias' in exclude:
+            return
+        same = type(self).objects.filter(alias_normalized=self.normalize(self.alias)).exclude(pk=self.pk)
+        if same.exists():
+            raise ValidationError({'alias': f'Alias {self.alias} differs from an existing one only by case'})
+
+    def save(self, *args, **kwargs):
+        self.alias_normalized = self.normalize(self.alias)
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = 'Alias'
         verbose_name_plural = 'Aliases'
         ordering = ['subscription',]
 
 
+class ProcessedUpdate(models.Model):
+    """Telegram update handled by one of the bot's workers. Lets a redelivered update be skipped by any worker"""
+    update_id = models.BigIntegerField(primary_key=True, verbose_name='Update id')
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Processed at')
+
+    def __str__(self):
+        return f'{self.update_id}'
+
+    class Meta:
+        verbose_name = 'Processed update'
+        verbose_name_plural = 'Processed updates'
+
+
+class OutboxPost(models.Model):
+    """Post grabbed by a poller worker and waiting to be sent to telegram by the bot's process"""
+    chat_id = models.BigIntegerField(verbose_name='Chat id')
+    priority = models.SmallIntegerField(default=1, verbose_name='Priority')
+    text = models.TextField(verbose_name='Text')
+    photo_urls = models.JSONField(default=list, blank=True, verbose_name='Photo urls')
+    post_id = models.CharField(max_length=256, null=True, blank=True, verbose_name='Post id')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created at')
+    # the relay sending the post. Its claim lapses after a lease, so posts of a stopped relay are sent by others
+    claimed_by = models.CharField(max_length=255, null=True, blank=True, verbose_name='Claimed by')
+    claimed_at = models.DateTimeField(null=True, blank=True, verbose_name='Claimed at')
+
+    def __str__(self):
+        return f'Post {self.post_id} to {self.chat_id}'
+
+    class Meta:
+        verbose_name = 'Outbox post'
+        verbose_name_plural = 'Outbox posts'
+
+
 class LastPostForUser(models.Model):
     subscription = models.ForeignKey(Subscription, null=False, blank=False, on_delete=models.CASCADE)
     telegram_user = models.ForeignKey(TelegramUser, blank=False, null=False, on_delete=models.CASCADE)
     last_post_id = models.CharField(max_length=256, null=True, blank=True)
+    listening = models.BooleanField(default=False)  # the user gets new posts of the subscription as they appear
+    chat_id = models.BigIntegerField(null=True, blank=True)  # where new posts are sent while listening
+    shard_key = models.BigIntegerField(default=0)  # crc32 of the subscription token, see services.sharding
+    listen_changed_at = models.DateTimeField(null=True, blank=True)  # when listening was last started or stopped
 
     def __str__(self):
         return f'Last post for {self.telegram_user.name} in {self.subscription}: {self.last_post_id}'
@@ -68,3 +126,11 @@ class LastPostForUser(models.Model):
         verbose_name = 'Last post'
         verbose_name_plural = 'Last posts'
         ordering = ['telegram_user',]
+        constraints = [
+            models.UniqueConstraint(fields=['telegram_user', 'subscription'], name='unique_last_post_for_user'),
+        ]
+        indexes = [
+            models.Index(fields=['subscription', 'telegram_user'], name='last_post_subscription_user'),
+            models.Index(fields=['listening', 'id'], name='last_post_listening'),
+            models.Index(fields=['listen_changed_at'], name='last_post_listen_changed'),
+        ]